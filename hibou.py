@@ -1,22 +1,33 @@
 # -*- coding:utf-8 -*-
 
+import ast
 import asyncio
+import builtins
 import cgi
+import collections
+import email.utils
+import hashlib
 import importlib
+import importlib.util
+import inspect
 import io
 import os
-import queue
 import re
 import selectors
+import signal
+import stat
+import symtable
 import socket
 import ssl
 import sys
 import time
 import logging
+import marshal
 import types
 import urllib.parse
 import uuid
 import threading
+import zlib
 
 
 RESPONSE_CODE_DEFINED = {
@@ -54,6 +65,7 @@ RESPONSE_CODE_DEFINED = {
     415: 'Unsupported Media Type',
     416: 'Requested Range Not Satisfiable',
     417: 'Expectation Failed',
+    431: 'Request Header Fields Too Large',
     500: 'Internal Server Error',
     501: 'Not Implemented',
     502: 'Bad Gateway',
@@ -96,6 +108,11 @@ MINE_TYPE_DEFINED = {
 }
 
 
+# 可以压缩的内容类型，字体和图片等本身已经压缩过的类型不再压缩
+COMPRESS_MIME_TYPES = ("text/html", "text/css", "text/plain", "text/json", "text/xml", "text/javascript",
+                       "application/javascript", "application/json", "application/xml", "image/svg+xml")
+
+
 class Utils:
 
     @staticmethod
@@ -115,6 +132,41 @@ class Utils:
             zone = "GMT"
         return time.strftime('%a, %d %b %Y %H:%M:%S {0}'.format(zone), time_local)
 
+    @staticmethod
+    def http_date(timestamp=None):
+        # HTTP头中使用的时间，必须是GMT时间，timestamp为None时是当前时间
+        return Utils.to_rfc822(time.gmtime(timestamp))
+
+    @staticmethod
+    def parse_http_date(value:str):
+        # 解析HTTP头中的时间，返回时间戳，格式错误返回None
+        try:
+            parsed = email.utils.parsedate_tz(value)
+            if parsed is None:
+                return None
+            return email.utils.mktime_tz(parsed)
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    @staticmethod
+    def etag_match(header:str, etag:str, weak=True):
+        """
+        检查If-None-Match、If-Match、If-Range中的ETag列表是否包含etag
+        :param weak: 弱比较，忽略W/前缀；强比较时W/开头的ETag都不匹配
+        """
+        header = header.strip()
+        if header == "*":
+            return True
+        for value in header.split(","):
+            value = value.strip()
+            if value.startswith("W/"):
+                if not weak:
+                    continue
+                value = value[2:]
+            if value == etag:
+                return True
+        return False
+
     @staticmethod
     def exec_code(code, glob, loc=None):
         # 执行给定的代码字符串
@@ -125,24 +177,100 @@ class Utils:
     @staticmethod
     def to_utf8(data):
         # 将数据转换为UTF-8编码
-        try:
-            if isinstance(data, str):
-                return data
-            elif isinstance(data, bytes):
+        if isinstance(data, str):
+            return data
+        elif isinstance(data, bytes):
+            try:
                 return data.decode("utf-8")
-            else:
-                return str(data)
-        except Exception as e:
-            logging.exception("to_utf8 error:%s data:%s", e, data)
-        return data
+            except UnicodeDecodeError as e:
+                logging.exception("to_utf8 error:%s data:%s", e, data)
+                return data
+        return str(data)
 
     @staticmethod
     def html_escape(data):
         # 将数据进行HTML转义
+        # 连续的str.replace都在C中执行，比正则或者str.translate的单次遍历都快，不需要转义的字符串也只是几次扫描
         if isinstance(data, str):
             return data.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;").replace("'", "&#039;")
         return data
 
+    @staticmethod
+    def html_escape_text(data):
+        # 转换成字符串后进行HTML转义，用于模板中表达式的输出，字符串直接转义，数字不需要转义
+        cls = data.__class__
+        if cls is not str:
+            if cls is int or cls is float:
+                return str(data)
+            data = Utils.to_utf8(data)
+            if not isinstance(data, str):
+                return data
+        return data.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;").replace("'", "&#039;")
+
+    @staticmethod
+    def is_compressible(content_type:str):
+        # 内容类型是否适合压缩，content_type可以带charset等参数
+        return content_type.partition(";")[0].strip().lower() in COMPRESS_MIME_TYPES
+
+    @staticmethod
+    def select_encoding(accept_encoding:str, encodings=("gzip", "deflate")):
+        """
+        根据请求头中的Accept-Encoding选择压缩方式
+        :param accept_encoding: 例如：gzip, deflate;q=0.5
+        :param encodings: 服务器支持的压缩方式，q值相同时靠前的优先
+        :return: 选择的压缩方式，客户端不支持压缩返回None
+        """
+        if not accept_encoding:
+            return None
+        qualities = {}
+        for item in accept_encoding.split(","):
+            name, _, params = item.partition(";")
+            quality = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            qualities[name.strip().lower()] = quality
+        best, best_quality = None, 0.0
+        for name in encodings:
+            quality = qualities.get(name, qualities.get("*", 0.0))
+            if quality > best_quality:
+                best, best_quality = name, quality
+        return best
+
+    @staticmethod
+    def compress(data, encoding, level=6):
+        # 使用gzip或者deflate压缩数据
+        wbits = 31 if encoding == "gzip" else 15
+        compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def copy_file(src, dst):
+        """
+        复制文件，优先使用os.copy_file_range在内核中复制，数据不经过用户空间，不支持时（跨文件系统等）按块读写
+        """
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            if hasattr(os, "copy_file_range"):
+                size = os.fstat(fsrc.fileno()).st_size
+                try:
+                    while size > 0:
+                        count = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size)
+                        if count == 0:
+                            break
+                        size -= count
+                    return
+                except OSError:
+                    # copy_file_range会移动文件的位置，从已经复制的位置继续
+                    pass
+            while True:
+                chunk = fsrc.read(1024 * 1024)
+                if not chunk:
+                    break
+                fdst.write(chunk)
+
     @staticmethod
     def read_range(range_header:str, file_size:int):
         """
@@ -166,13 +294,19 @@ class Utils:
             start = Utils.int_or_none(start_b)
             end = Utils.int_or_none(end_b)
             if start is None:       # -xxx 最后xxx字节
-                start = end_index - end + 1
+                if end is None:
+                    return None
+                if end == 0:        # 最后0字节，无法满足
+                    continue
+                start = max(end_index - end + 1, 0)
                 end = end_index
             else:
                 if end is None:     # xxx-  从xxx开始到末尾
                     end = end_index
                 if start > end:     # 格式错误
                     return None
+                if start > end_index:   # 超出文件大小，无法满足
+                    continue
                 end = min(end, end_index)
             ranges.append((start, end))
 
@@ -195,8 +329,7 @@ class Utils:
         :param file_path:
         :return:
         """
-        file_mt = time.localtime(os.stat(file_path).st_mtime)
-        return Utils.to_rfc822(file_mt)
+        return Utils.http_date(os.stat(file_path).st_mtime)
 
     @staticmethod
     def get_file_mime_type(filename):
@@ -294,6 +427,34 @@ class Buffer:
             self.buffer.seek(0)
             return self.buffer.getvalue()
 
+    def move_to(self, path):
+        """
+        数据已经落地到临时文件时，直接把临时文件移动到path，不能移动时（跨文件系统）复制
+        :return: 是否已经保存，数据在内存中的返回False
+        """
+        if not self.file_buffer:
+            return False
+        self.file_buffer.close()
+        self.file_buffer = None
+        try:
+            os.replace(self.filename, path)
+        except OSError:
+            Utils.copy_file(self.filename, path)
+            os.remove(self.filename)
+        return True
+
+    def close(self):
+        # 关闭缓冲区，数据落地的删除临时文件
+        if self.file_buffer:
+            self.file_buffer.close()
+            self.file_buffer = None
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+        elif self.buffer:
+            self.buffer.close()
+
 
 # 模板渲染
 class UIModuleNameSpace(object):
@@ -332,55 +493,299 @@ class UIModule(object):
         return self.handler.render_string(path, **kwargs)
 
 
+class _TemplateUndefined(object):
+    """
+    模板中用到的变量渲染时没有传入时参数的默认值，生成的函数开始时检查到这个值就删除这个局部变量，
+    使用的时候和普通的Python代码一样抛出NameError（UnboundLocalError），{{ x is None }}这样的判断也会报错
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<undefined>"
+
+
+_TEMPLATE_UNDEFINED = _TemplateUndefined()
+
+
+class FragmentCache(object):
+    """
+    模板片段缓存，模板中使用 {% cache key ttl %}...{% end %} 缓存一段渲染好的内容，所有模板和线程共享
+    缓存的数量超过max_count或者内容的总长度超过max_length时淘汰最久没有使用的片段
+    """
+
+    def __init__(self, max_count=1024, max_length=1024 * 1024 * 64):
+        self.max_count = max_count
+        self.max_length = max_length
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()     # key -> (过期时间, 内容)
+        self._length = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                expire, value = item
+                if expire is None or expire > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl=None):
+        """
+        :param ttl: 有效的秒数，None表示一直有效直到被淘汰
+        """
+        if len(value) > self.max_length:
+            return
+        expire = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (expire, value)
+            self._length += len(value)
+            while len(self._items) > self.max_count or self._length > self.max_length:
+                self._remove(next(iter(self._items)))
+
+    def _remove(self, key):
+        expire, value = self._items.pop(key)
+        self._length -= len(value)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._length = 0
+
+    def stats(self):
+        with self._lock:
+            return {"count": len(self._items), "length": self._length,
+                    "hits": self.hits, "misses": self.misses}
+
+
 class Template(object):
     """ html渲染模版 使用tornado的模版去掉了他里面我不需要的内容重新组成 """
-
-    def __init__(self, template_string, name="<string>", modules=None, compress_whitespace=False):
+    # 内置的转换函数
+    HELPERS = {
+        "escape": Utils.html_escape,
+        "xhtml_escape": Utils.html_escape,
+        "_tt_utf8": Utils.to_utf8,
+        "_tt_escape": Utils.html_escape_text,
+    }
+    # 可以用_tt_escape代替的转义函数
+    BUILTIN_ESCAPES = ("xhtml_escape", "escape")
+    # 流式渲染时，循环中缓冲的内容超过这个数量就输出一块
+    STREAM_FLUSH_SIZE = 512
+    # 生成代码的版本，生成的代码有变化时修改，使磁盘上缓存的编译结果失效
+    CODE_VERSION = 3
+
+    def __init__(self, template_string, name="<string>", modules=None, compress_whitespace=False, cache_dir=None):
         """
         template_string  需要渲染的模版文本
         name  可选传入文件名方便识别
         compress_whitespace  是否需要压缩空行和换行等 一般js css需要
+        cache_dir  编译结果缓存的目录，不为空时编译好的代码使用marshal保存到这个目录，下次直接加载
         """
         self.name = name
         self.autoescape = "xhtml_escape"
         # modules 模块列表，用于html中引用其他模块 内置对象为 _tt_modules
         self.namespace = {"_tt_modules": modules} if modules else {}
+        # 模板中用到的外部变量，作为_tt_execute的参数
+        self.arguments = ()
         # 编译资源
         self.compiled = None
+        self._execute = None
+        self._stream = None
+        self.cache_dir = cache_dir
         self._compile_code(self.name, template_string, compress_whitespace)
 
     def generate(self, **kwargs):
         """ 根据指定的参数 生成模版 """
-        # 内置的转换函数
-        namespace = {
-            "escape": Utils.html_escape,
-            "xhtml_escape": Utils.html_escape,
-            "_tt_utf8": Utils.to_utf8,
-        }
-        namespace.update(self.namespace)
-        namespace.update(kwargs)
-        Utils.exec_code(self.compiled, namespace)
-        execute = namespace["_tt_execute"]
-        return execute()
+        return self._execute(**kwargs)
+
+    def stream(self, **kwargs):
+        """ 流式渲染，返回一个生成器，每次生成一块渲染好的内容 """
+        return self._stream(**kwargs)
 
     def _compile_code(self, name, template_string, compress_whitespace):
         """ 编译模版 """
+        # 模板内容的摘要，用于区分不同版本模板的片段缓存
+        self.source_hash = hashlib.sha1(template_string.encode("utf-8")).hexdigest()
+        cache_file = None
+        if self.cache_dir:
+            cache_file = self._cache_file(name, compress_whitespace)
+            compiled = self._load_cache(cache_file)
+            if compiled is not None:
+                self.compiled = compiled
+                self._load_functions(compiled)
+                return
         # 对模版进行解析
         body = _TemplateReader.parse_template(name, template_string, self)
         # 解析后的资源存入file中等待编译
         temp_file = _File(self, body)
-        # 创建内存buff
-        buffer = io.StringIO()
         try:
-            writer = _CodeWriter(buffer, self, compress_whitespace)
-            temp_file.generate(writer)
-            self.compiled = compile(buffer.getvalue(), name, "exec", dont_inherit=True)
+            # 先生成一次代码找出模板中用到的外部变量，再把这些变量作为参数重新生成
+            source = self._generate_source(temp_file, compress_whitespace)
+            self.arguments = self._find_global_names(source, name)
+            source = self._generate_source(temp_file, compress_whitespace)
+            self.compiled = compile(source, name, "exec", dont_inherit=True)
         except Exception as e:
             logging.exception("compile code error:%s", e)
             raise
+        self._load_functions(self.compiled)
+        if cache_file:
+            self._save_cache(cache_file, self.compiled)
+
+    def _cache_file(self, name, compress_whitespace):
+        # 模板内容、名称、编译选项、生成代码的版本和Python字节码的版本都相同时才能使用缓存
+        key = hashlib.sha1()
+        key.update(self.source_hash.encode("ascii"))
+        key.update(name.encode("utf-8"))
+        key.update(b"%d:%d" % (compress_whitespace, self.CODE_VERSION))
+        key.update(importlib.util.MAGIC_NUMBER)
+        return os.path.join(self.cache_dir, key.hexdigest() + ".tpc")
+
+    @staticmethod
+    def _load_cache(cache_file):
+        try:
+            with open(cache_file, "rb") as fp:
+                return marshal.load(fp)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning("load template cache:%s error:%s", cache_file, e)
+            return None
+
+    @staticmethod
+    def _save_cache(cache_file, compiled):
+        # 先写入临时文件再替换，多个进程同时写入也不会读到不完整的文件
+        temp_file = "{0}.{1}.tmp".format(cache_file, uuid.uuid4().hex)
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(temp_file, "wb") as fp:
+                marshal.dump(compiled, fp)
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            logging.warning("save template cache:%s error:%s", cache_file, e)
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+
+    def _generate_source(self, temp_file, compress_whitespace):
+        buffer = io.StringIO()
+        try:
+            writer = _CodeWriter(buffer, self, compress_whitespace)
+            temp_file.generate(writer)
+            return buffer.getvalue()
         finally:
             buffer.close()
 
+    @staticmethod
+    def _find_global_names(source, name):
+        """ 找出_tt_execute（包括里面的推导式、lambda等）中引用的全局变量 """
+        names = []
+        tables = symtable.symtable(source, name, "exec").get_children()
+        while tables:
+            table = tables.pop()
+            for symbol in table.get_symbols():
+                if symbol.is_global() and symbol.is_referenced() and symbol.get_name() not in names:
+                    names.append(symbol.get_name())
+            tables.extend(table.get_children())
+        names.sort()
+        return tuple(names)
+
+    def _load_functions(self, compiled):
+        """
+        执行编译好的代码得到_tt_execute和流式渲染的_tt_stream函数，模板中用到的外部变量都是它们的关键字参数，
+        默认值依次从modules、内置转换函数、builtins中查找，都没有的使用_TemplateUndefined，渲染时没有传入的在使用时抛出NameError
+        """
+        namespace = {"__builtins__": builtins}
+        exec(compiled, namespace)
+        self._execute = self._bind_defaults(namespace["_tt_execute"])
+        self._stream = self._bind_defaults(namespace["_tt_stream"])
+        code = self._execute.__code__
+        self.arguments = code.co_varnames[:code.co_kwonlyargcount]
+
+    def _bind_defaults(self, execute):
+        defaults = {}
+        for arg_name in execute.__code__.co_varnames[:execute.__code__.co_kwonlyargcount]:
+            if arg_name in self.namespace:
+                defaults[arg_name] = self.namespace[arg_name]
+            elif arg_name in self.HELPERS:
+                defaults[arg_name] = self.HELPERS[arg_name]
+            elif arg_name == "_tt_cache":
+                defaults[arg_name] = Application.ins().fragment_cache
+            elif arg_name == "_tt_undefined":
+                defaults[arg_name] = _TEMPLATE_UNDEFINED
+            elif hasattr(builtins, arg_name):
+                defaults[arg_name] = getattr(builtins, arg_name)
+            else:
+                defaults[arg_name] = _TEMPLATE_UNDEFINED
+        execute.__kwdefaults__ = defaults
+        return execute
+
+
+class TemplateLoader(object):
+    """
+    模板加载器，从模板根目录加载模板文件，编译好的模板会缓存起来
+    文件的修改时间或大小变化后重新编译，缓存的数量超过max_size时淘汰最久没有使用的模板
+    """
+
+    def __init__(self, root, max_size=256, cache_dir=None):
+        self.root = root
+        self.max_size = max_size
+        self.cache_dir = cache_dir      # 编译结果的磁盘缓存目录
+        self._templates = collections.OrderedDict()     # filename -> (修改时间, 文件大小, Template)
+        self._lock = threading.Lock()
+
+    def load(self, name):
+        """ 加载模板，name为相对模板根目录的路径 """
+        filename = os.path.join(self.root, name)
+        try:
+            file_stat = os.stat(filename)
+        except FileNotFoundError:
+            raise FileExistsError("{0} not found".format(filename))
+        if not stat.S_ISREG(file_stat.st_mode):
+            raise FileNotFoundError("{0} not file".format(filename))
+        with self._lock:
+            cached = self._templates.get(filename)
+            if cached and cached[0] == file_stat.st_mtime_ns and cached[1] == file_stat.st_size:
+                self._templates.move_to_end(filename)
+                return cached[2]
+        # 编译不需要加锁，多个线程同时编译同一个模板时以最后一个为准
+        with open(filename, "r", encoding="utf-8") as fp:
+            template = Template(fp.read(), filename, cache_dir=self.cache_dir)
+        with self._lock:
+            self._templates[filename] = (file_stat.st_mtime_ns, file_stat.st_size, template)
+            self._templates.move_to_end(filename)
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+        return template
+
+    def precompile(self):
+        """ 编译模板目录下的所有模板，返回编译成功的数量 """
+        count = 0
+        for root, dirs, files in os.walk(self.root):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            for file in files:
+                if file.startswith("."):
+                    continue
+                name = os.path.relpath(os.path.join(root, file), self.root)
+                try:
+                    self.load(name)
+                    count += 1
+                except Exception as e:
+                    logging.exception("precompile template:%s error:%s", name, e)
+        return count
+
+    def reset(self):
+        """ 清空缓存，下次使用时重新编译 """
+        with self._lock:
+            self._templates.clear()
+
 
 class _Node(object):
     def generate(self, writer):
@@ -394,12 +799,34 @@ class _File(_Node):
         self.line = 0
 
     def generate(self, writer):
-        writer.write_line("def _tt_execute():", self.line)
-        with writer.indent():
-            writer.write_line("_tt_buffer = []", self.line)
-            writer.write_line("_tt_append = _tt_buffer.append", self.line)
-            self.body.generate(writer)
-            writer.write_line("return _tt_utf8('').join(_tt_buffer)", self.line)
+        # 模板用到的外部变量和内置函数都作为关键字参数传入，在函数内是局部变量，没有用到的参数放入_tt_extra
+        arguments = ["*"] + list(self.template.arguments) if self.template.arguments else []
+        # 只能由渲染参数提供的变量，没有传入时删除局部变量，使用时抛出NameError
+        undefined = [name for name in self.template.arguments if self.may_undefined(name)]
+        if undefined:
+            arguments.append("_tt_undefined")
+        arguments.append("**_tt_extra")
+        # 同一份模板生成两个函数：_tt_execute返回完整的内容，_tt_stream是生成器，在循环中分块输出
+        for name, streaming in (("_tt_execute", False), ("_tt_stream", True)):
+            writer.streaming = streaming
+            writer.write_line("def %s(%s):" % (name, ", ".join(arguments)), self.line)
+            with writer.indent():
+                for arg_name in undefined:
+                    writer.write_line("if %s is _tt_undefined: del %s" % (arg_name, arg_name), self.line)
+                writer.write_line("_tt_buffer = []", self.line)
+                writer.write_line("_tt_append = _tt_buffer.append", self.line)
+                writer.write_line("_tt_extend = _tt_buffer.extend", self.line)
+                self.body.generate(writer)
+                if streaming:
+                    writer.write_line("yield ''.join(_tt_buffer)", self.line)
+                else:
+                    writer.write_line("return ''.join(_tt_buffer)", self.line)
+        writer.streaming = False
+
+    @staticmethod
+    def may_undefined(name):
+        # 内部变量、内置转换函数和builtins都有默认值
+        return not name.startswith("_tt_") and name not in Template.HELPERS and not hasattr(builtins, name)
 
 
 class _ChunkList(_Node):
@@ -407,8 +834,42 @@ class _ChunkList(_Node):
         self.chunks = chunks
 
     def generate(self, writer):
+        # 连续的文本和表达式合并成一次输出，中间遇到控制语句时先把前面的输出写出
+        outputs = []
         for chunk in self.chunks:
+            if isinstance(chunk, (_Text, _Expression)):
+                outputs.extend(chunk.output(writer))
+                continue
+            self.write_output(writer, outputs)
+            outputs = []
             chunk.generate(writer)
+        self.write_output(writer, outputs)
+
+    @staticmethod
+    def write_output(writer, outputs):
+        """
+        输出一组内容，相邻的文本合并成一个常量，多个内容使用一次_tt_extend
+        :param outputs: [(是否常量, 常量的文本或者表达式的代码, 行号)]
+        """
+        merged = []
+        for item in outputs:
+            if item[0] and merged and merged[-1][0]:
+                merged[-1] = (True, merged[-1][1] + item[1], merged[-1][2])
+            else:
+                merged.append(item)
+        items = [(repr(value) if is_const else value, line) for is_const, value, line in merged if value != ""]
+        if not items:
+            return
+        if len(items) == 1 or writer.try_depth:
+            for code, line in items:
+                writer.write_line("_tt_append(%s)" % code, line)
+            return
+        # 每个内容单独一行，出错时能对应到模板的行号
+        writer.write_line("_tt_extend((", items[0][1])
+        with writer.indent():
+            for code, line in items:
+                writer.write_line("%s," % code, line)
+        writer.write_line("))", items[-1][1])
 
 
 class _ControlBlock(_Node):
@@ -419,10 +880,55 @@ class _ControlBlock(_Node):
 
     def generate(self, writer):
         writer.write_line("%s:" % self.statement, self.line)
+        is_try = self.statement.startswith("try")
+        if is_try:
+            writer.try_depth += 1
         with writer.indent():
+            if writer.streaming and not writer.cache_depth and self.statement.startswith(("for", "while")):
+                # 流式渲染时每次循环检查一下缓冲的内容，足够多就先输出
+                writer.write_line("if len(_tt_buffer) >= %d:" % Template.STREAM_FLUSH_SIZE, self.line)
+                with writer.indent():
+                    writer.write_line("yield ''.join(_tt_buffer)", self.line)
+                    writer.write_line("_tt_buffer.clear()", self.line)
             self.body.generate(writer)
             # Just in case the body was empty
             writer.write_line("pass", self.line)
+        if is_try:
+            writer.try_depth -= 1
+
+
+class _CacheBlock(_Node):
+    """
+    {% cache key ttl %}...{% end %}
+    命中时直接输出缓存的内容；没有命中时渲染内容，从_tt_buffer中取出这一段合并后存入缓存
+    """
+    def __init__(self, key, ttl, line, body, position=0):
+        self.key = key
+        self.ttl = ttl
+        self.line = line
+        self.body = body
+        self.position = position    # 在模板中的位置，区分同一行的多个片段
+
+    def generate(self, writer):
+        template = writer.current_template
+        key = writer.new_var("_tt_cache_key")
+        start = writer.new_var("_tt_cache_start")
+        # 缓存的key加上模板的摘要和片段的位置，不同模板、不同片段或者模板修改后不会取到旧的内容
+        writer.write_line("%s = (%r, %d, %s)" % (key, template.source_hash, self.position, self.key), self.line)
+        writer.write_line("_tt_fragment = _tt_cache.get(%s)" % key, self.line)
+        writer.write_line("if _tt_fragment is not None:", self.line)
+        with writer.indent():
+            writer.write_line("_tt_append(_tt_fragment)", self.line)
+        writer.write_line("else:", self.line)
+        writer.cache_depth += 1
+        with writer.indent():
+            writer.write_line("%s = len(_tt_buffer)" % start, self.line)
+            self.body.generate(writer)
+            writer.write_line("_tt_fragment = ''.join(_tt_buffer[%s:])" % start, self.line)
+            writer.write_line("del _tt_buffer[%s:]" % start, self.line)
+            writer.write_line("_tt_append(_tt_fragment)", self.line)
+            writer.write_line("_tt_cache.set(%s, _tt_fragment, %s)" % (key, self.ttl or "None"), self.line)
+        writer.cache_depth -= 1
 
 
 class _IntermediateControlBlock(_Node):
@@ -452,12 +958,33 @@ class _Expression(_Node):
         self.raw = raw
 
     def generate(self, writer):
-        writer.write_line("_tt_tmp = %s" % self.expression, self.line)
-        writer.write_line("_tt_tmp = _tt_utf8(_tt_tmp)", self.line)
-        if not self.raw and writer.current_template.autoescape is not None:
-            writer.write_line("_tt_tmp = _tt_utf8(%s(_tt_tmp))" %
-                              writer.current_template.autoescape, self.line)
-        writer.write_line("_tt_append(_tt_tmp)", self.line)
+        _ChunkList.write_output(writer, self.output(writer))
+
+    def output(self, writer):
+        autoescape = None if self.raw else writer.current_template.autoescape
+        # 字符串和数字的字面量在编译时直接转换成文本
+        constant = self._literal()
+        if constant is not None and (autoescape is None or autoescape in Template.BUILTIN_ESCAPES):
+            constant = str(constant)
+            if autoescape is not None:
+                constant = Utils.html_escape(constant)
+            return [(True, constant, self.line)]
+        if autoescape is None:
+            code = "_tt_utf8(%s)" % self.expression
+        elif autoescape in Template.BUILTIN_ESCAPES:
+            code = "_tt_escape(%s)" % self.expression
+        else:
+            code = "_tt_utf8(%s(_tt_utf8(%s)))" % (autoescape, self.expression)
+        return [(False, code, self.line)]
+
+    def _literal(self):
+        try:
+            value = ast.literal_eval(self.expression)
+        except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+            return None
+        if type(value) in (str, int):
+            return value
+        return None
 
 
 class _Module(_Expression):
@@ -471,6 +998,9 @@ class _Text(_Node):
         self.line = line
 
     def generate(self, writer):
+        _ChunkList.write_output(writer, self.output(writer))
+
+    def output(self, writer):
         value = self.value
 
         # Compress lots of white space to a single character. If the whitespace
@@ -480,8 +1010,9 @@ class _Text(_Node):
             value = re.sub(r"([\t ]+)", " ", value)
             value = re.sub(r"(\s*\n\s*)", "\n", value)
 
-        if value:
-            writer.write_line('_tt_append(%r)' % Utils.to_utf8(value), self.line)
+        if not value:
+            return []
+        return [(True, value, self.line)]
 
 
 class ParseError(Exception):
@@ -495,6 +1026,15 @@ class _CodeWriter(object):
         self.current_template = current_template
         self.compress_whitespace = compress_whitespace
         self._indent = 0
+        self.try_depth = 0      # 在try块中时，异常之前的内容要已经输出，不能合并到一次_tt_extend
+        self.streaming = False  # 是否正在生成流式渲染的函数
+        self.cache_depth = 0    # 在cache块中时，内容要完整的留在_tt_buffer中，流式渲染也不能分块输出
+        self._var_index = 0
+
+    def new_var(self, prefix):
+        # 生成不重复的临时变量名
+        self._var_index += 1
+        return "%s%d" % (prefix, self._var_index)
 
     def indent_size(self):
         return self._indent
@@ -580,6 +1120,38 @@ class _TemplateReader(object):
     def parse_template(name, text, template):
         return _TemplateReader._parse(_TemplateReader(name, text), template)
 
+    CACHE_TTL_NUMBER = re.compile(r"\s+(\d+(?:\.\d*)?)$")
+    CACHE_TTL_ARG = re.compile(r"\s+ttl\s*=(?!=)")
+
+    @staticmethod
+    def _is_expression(code):
+        try:
+            ast.parse(code, mode="eval")
+        except SyntaxError:
+            return False
+        return True
+
+    @staticmethod
+    def _parse_cache_args(suffix):
+        """
+        解析cache的参数，返回(key, ttl)，key中可以有空格，例如 "d-%s" % uid、f(a, b)
+        ttl是最后的数字，或者使用ttl=表达式（表达式中可以有空格），例如 {% cache key ttl=60 * 5 %}
+        分开后key不是完整的表达式时，整个作为key
+        """
+        match = None
+        for match in _TemplateReader.CACHE_TTL_ARG.finditer(suffix):
+            pass
+        if match is None:
+            match = _TemplateReader.CACHE_TTL_NUMBER.search(suffix)
+            ttl = match.group(1) if match else None
+        else:
+            ttl = suffix[match.end():].strip()
+        if match is not None:
+            key = suffix[:match.start()]
+            if _TemplateReader._is_expression(key) and _TemplateReader._is_expression(ttl):
+                return key, ttl
+        return suffix, None
+
     @staticmethod
     def _parse(reader, template, in_block=None, in_loop=None):
         body = _ChunkList([])
@@ -714,6 +1286,17 @@ class _TemplateReader(object):
                 body.chunks.append(block)
                 continue
 
+            elif operator == "cache":
+                # {% cache key ttl %}，ttl可以省略，key可以是任意表达式
+                if not suffix:
+                    raise ParseError("cache missing key on line %d" % line)
+                key, ttl = _TemplateReader._parse_cache_args(suffix)
+                position = reader.pos
+                # 片段需要完整的渲染，里面不能break或continue外层的循环
+                block_body = _TemplateReader._parse(reader, template, operator, None)
+                body.chunks.append(_CacheBlock(key, ttl, line, block_body, position))
+                continue
+
             elif operator in ("break", "continue"):
                 if not in_loop:
                     raise ParseError("%s outside %s block" % (operator, {"for", "while"}))
@@ -733,17 +1316,29 @@ class Field:
         return "name={0}, value={1}".format(self.name, self.value)
 
 class FileField:
-    def __init__(self, name, filename, filetype, buffer, size:int):
+    def __init__(self, name, filename, filetype, buffer, size:int, path=None):
         self.name = name
         self.filename = filename
         self.filetype = filetype
-        self._buffer = buffer   #type: io.FileIO or io.BytesIO
+        self._buffer = buffer   #type: Buffer
         self.size = size
+        self.path = path        # 文件已经保存的路径，例如DirectorySink接收时直接写入的文件
 
     def __str__(self):
         return "name={0}, filename={1}, type={2}, size={3}".format(self.name, self.filename, self.filetype, self.size)
 
     def save(self, path):
+        # 已经保存在磁盘上的使用copy_file_range复制，临时文件直接移动过去，只有内存中的数据需要写入
+        if self.path:
+            if os.path.abspath(self.path) != os.path.abspath(path):
+                Utils.copy_file(self.path, path)
+            return
+        if self._buffer is None:
+            raise ValueError("{0} has been written to the upload sink".format(self.name))
+        if isinstance(self._buffer, Buffer) and self._buffer.move_to(path):
+            self._buffer = None
+            self.path = path
+            return
         with open(path, 'wb') as f:
             content_length = self.size
             while content_length > 0:
@@ -755,123 +1350,343 @@ class FileField:
 
     def read(self, size):
         assert size <= self.size, "读取超过"
+        if self._buffer is None:
+            if not self.path:
+                raise ValueError("{0} has been written to the upload sink".format(self.name))
+            self._buffer = io.FileIO(self.path, "rb")
         return self._buffer.read(size)
 
+    def close(self):
+        # 释放上传的数据，请求结束时调用，已经保存的文件不会删除
+        if self._buffer is not None:
+            self._buffer.close()
+
+
+class UploadSink:
+    """
+    上传文件的接收方式，在处理类的upload_sinks或者route中按字段名声明，"*"匹配其他所有的文件字段
+    解析multipart时每个文件通过open打开写入的目标，数据一边接收一边写入，全部接收后调用finish生成FileField，
+    整个请求体解析成功后才对所有的文件调用commit，请求失败时正在接收的调用abort，已经接收完成的调用discard
+    默认写入Buffer，超过MEMORY_SIZE时落地到临时文件，FileField.save时直接移动临时文件
+    max_size: 单个文件的最大字节数，超过时返回413
+    """
+    MEMORY_SIZE = 1024 * 1024
+
+    def __init__(self, max_size:int=None):
+        self.max_size = max_size
 
-class MultipartParser:
-    def __init__(self, buffer:Buffer, boundary:bytes):
-        self.buffer = buffer
-        self.boundary = b"--" + boundary
-        self.end_boundary = self.boundary + b'--'
-        self.leftover = b""
-        self.buffer_size = 8192
-        self.HTTP_LRE = "\r\n"
-
-    def read_boundary(self):
-        size = len(self.boundary) * 2   # 读取
-        buf = b""
-        while True:
-            chunk = self.buffer.read(size)
-            if not chunk:
-                break
-            buf += chunk
-            boundary_idx = buf.find(self.boundary)
-            if boundary_idx == -1:  # 说明没找到
-                buf = chunk     # 将buf指向当前的chunk部分，与下一个chunk拼接后查找
-                continue
-            # 假设boundary长度为5， 那么读取10字节后，位置在900， 那么开始的位置是890
-            # 真正的数据范围是890 + boundary_idx的位置。
-            end_pos = self.buffer.tell() - len(buf) + boundary_idx
-            # 将buffer的读取位置指向刚好跳过分割位置
-            return end_pos
-        return -1
+    def open(self, name, filename, content_type):
+        """ 返回写入数据的对象，需要有write方法 """
+        return Buffer(uuid.uuid4().hex, self.MEMORY_SIZE)
 
-    @staticmethod
-    def parse_multipart_form_head(data: str):
-        # form-data的头内容解析
-        # Content-Disposition: form-data; name="name of pdf"; filename="pdf-file.pdf"
-        # Content-Type: application/octet-stream
-        headers = {}
-        for i, item in enumerate(data.split(";")):
-            if i == 0:
-                kv = item.split(":")
-            else:
-                kv = item.split("=")
-            if len(kv) == 2:
-                headers[kv[0].strip().lower()] = kv[1].strip()
-        return headers
+    def finish(self, fp, name, filename, content_type, size):
+        """ 文件接收完成，返回FileField """
+        fp.flip()
+        return FileField(name, filename, content_type, fp, size)
 
-    def read_headers(self):
-        form_headers = {}  # 读取multipart/form-data的头
-        while True:
-            line = self.buffer.readline()
-            if line.startswith(b"\r\n"):  # 读取结束
-                break
-            headers = self.parse_multipart_form_head(line.decode("utf-8"))
-            form_headers.update(headers)
-        return form_headers
+    def commit(self, field:FileField):
+        """ 整个请求体解析成功后调用 """
+        pass
 
-    def read_data(self, content_length):
-        buffer = io.BytesIO()
-        while content_length > 0:
-            chunk = self.buffer.read(content_length)
-            if not chunk:
-                break
-            buffer.write(chunk)
-            content_length -= len(chunk)
-        return buffer
+    def abort(self, fp):
+        """ 请求失败时调用，清理正在接收的数据 """
+        fp.close()
 
-    def parse(self):
-        # 跳过第一个boundary
-        fields = []
-        while True:
-            field = self.parse_field()
-            if not field:
-                break
-            fields.append(field)
-        return fields
+    def discard(self, field:FileField):
+        """ 请求失败时调用，清理已经接收完成（或者已经commit）的文件 """
+        field.close()
 
-    def parse_field(self):
-        line = self.buffer.readline()
-        if not line or not line.startswith(self.boundary):
-            return
-        # 结束标记
-        if line.startswith(self.end_boundary):
+
+class DirectorySink(UploadSink):
+    """
+    上传的文件直接写入directory目录，接收时写入目录下的临时文件，整个请求解析成功后重命名为上传的文件名，数据只写一次
+    name: 生成保存文件名的函数 name(filename)，默认使用上传的文件名（去掉路径）
+    overwrite: 是否覆盖已经存在的文件，默认不覆盖，重名时在文件名后面加上序号，例如a-1.js
+    """
+    MAX_RENAME = 1000   # 重名时最多尝试的序号
+    TEMP_SUFFIX = ".uploading"
+
+    def __init__(self, directory, max_size:int=None, name=None, overwrite=False):
+        super().__init__(max_size)
+        self.directory = directory
+        self.name = name
+        self.overwrite = overwrite
+
+    def file_name(self, filename):
+        if self.name is not None:
+            return self.name(filename)
+        # 客户端发送的文件名可能带有路径，只保留文件名，避免写到目录外面
+        filename = os.path.basename(filename.replace("\\", "/"))
+        if filename in ("", ".", ".."):
+            filename = uuid.uuid4().hex
+        return filename
+
+    def open(self, name, filename, content_type):
+        os.makedirs(self.directory, exist_ok=True)
+        return io.FileIO(os.path.join(self.directory, ".{0}{1}".format(uuid.uuid4().hex, self.TEMP_SUFFIX)), "wb")
+
+    def finish(self, fp, name, filename, content_type, size):
+        # 先留在临时文件中，commit时才移动到最终的位置
+        fp.close()
+        return FileField(name, filename, content_type, None, size, fp.name)
+
+    def commit(self, field:FileField):
+        temp = field.path
+        base, ext = os.path.splitext(self.file_name(field.filename))
+        if self.overwrite:
+            field.path = os.path.join(self.directory, base + ext)
+            os.replace(temp, field.path)
             return
-        headers = self.read_headers()
-        start_pos = self.buffer.tell()      # 上面已经读取完头，那么这里的起始位置就是body的开始
-        end_pos = self.read_boundary()      # 下一个body的开始位置，就是整个body的内容
-        if end_pos == -1:
+        for index in range(self.MAX_RENAME):
+            path = os.path.join(self.directory, "{0}-{1}{2}".format(base, index, ext) if index else base + ext)
+            # 使用硬链接创建目标文件，已经存在时失败，不会覆盖其他请求同时写入的文件
+            try:
+                os.link(temp, path)
+            except FileExistsError:
+                continue
+            except OSError:
+                # 文件系统不支持硬链接，先用O_EXCL创建空文件占用文件名，再替换成上传的文件
+                try:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                except FileExistsError:
+                    continue
+                os.replace(temp, path)
+            else:
+                os.remove(temp)
+            field.path = path
             return
-        disposition = headers.get("content-disposition", "")
-        name = headers.get("name", "")
-        if not disposition or not name or not disposition.startswith("form-data"):
+        logging.error("upload file:%s already exists", os.path.join(self.directory, base + ext))
+        raise RequestParseException(409, "Conflict")
+
+    def abort(self, fp):
+        fp.close()
+        self._remove(fp.name)
+
+    def discard(self, field:FileField):
+        # 没有commit的还是临时文件；不覆盖时commit之后的文件也是这次请求新建的，都可以直接删除
+        field.close()
+        if field.path and (not self.overwrite or field.path.endswith(self.TEMP_SUFFIX)):
+            self._remove(field.path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class CallableSink(UploadSink):
+    """
+    由函数决定文件写入的地方，func(name, filename, content_type)返回有write方法的对象（例如打开的文件、socket的makefile），
+    接收完成或者失败时调用它的close，生成的FileField不能再读取和保存
+    数据是边接收边交给写入对象的，请求失败时已经写入的数据需要写入对象自己在close时处理
+    """
+
+    def __init__(self, func, max_size:int=None):
+        super().__init__(max_size)
+        self.func = func
+
+    def open(self, name, filename, content_type):
+        return self.func(name, filename, content_type)
+
+    def finish(self, fp, name, filename, content_type, size):
+        self.abort(fp)
+        return FileField(name, filename, content_type, None, size)
+
+    def abort(self, fp):
+        close = getattr(fp, "close", None)
+        if close is not None:
+            close()
+
+
+class MultipartParser:
+    """
+    multipart/form-data的流式解析，接收请求体的同时解析，不需要先把整个请求体保存下来再读取一遍
+    接收到的数据通过write写入，每个文件按字段名选择UploadSink，直接写入它打开的目标，全部写入后调用finish
+    分隔符使用bytes.find在接收到的数据中查找，数据末尾不足一个分隔符长度的部分保留下来和后面的数据一起查找
+    """
+    PREAMBLE = 0    # 第一个分隔符之前
+    PART_START = 1  # 分隔符之后，判断是下一个部分还是结束
+    HEADERS = 2     # 部分的头
+    BODY = 3        # 部分的内容
+    END = 4         # 结束分隔符之后
+    MAX_HEADER_SIZE = 1024 * 16     # 每个部分的头的最大长度
+
+    def __init__(self, boundary:bytes, sinks:dict=None):
+        self.delimiter = b"\r\n--" + boundary
+        self.sinks = sinks or {}    # 字段名 -> UploadSink
+        self.default_sink = UploadSink()
+        self.fields = []        # 解析完成的Field和FileField
+        self._files = []        # 接收完成的文件 (UploadSink, FileField)，解析成功后commit
+        self._buf = bytearray(b"\r\n")     # 第一个分隔符前面没有换行，补上后可以统一查找
+        self._state = MultipartParser.PREAMBLE
+        self._part = None       # 当前部分 [name, filename, content_type, 写入的对象, size, UploadSink]
+
+    def write(self, data):
+        self._buf += data
+        self._parse()
+
+    def _parse(self):
+        buf = self._buf
+        delimiter = self.delimiter
+        while buf:
+            state = self._state
+            if state == MultipartParser.BODY or state == MultipartParser.PREAMBLE:
+                index = buf.find(delimiter)
+                if index < 0:
+                    # 末尾可能是分隔符的前一部分，保留下来
+                    index = len(buf) - len(delimiter) + 1
+                    if index <= 0:
+                        return
+                    if state == MultipartParser.BODY:
+                        self._write_part(buf, index)
+                    del buf[:index]
+                    return
+                if state == MultipartParser.BODY:
+                    self._write_part(buf, index)
+                    self._end_part()
+                del buf[:index + len(delimiter)]
+                self._state = MultipartParser.PART_START
+            elif state == MultipartParser.PART_START:
+                if len(buf) < 2:
+                    return
+                if buf.startswith(b"--"):
+                    # 结束分隔符，后面的内容忽略
+                    self._state = MultipartParser.END
+                    buf.clear()
+                    return
+                # 分隔符所在行的剩余部分
+                index = buf.find(b"\r\n")
+                if index < 0:
+                    self._check_header_size()
+                    return
+                del buf[:index + 2]
+                self._state = MultipartParser.HEADERS
+            elif state == MultipartParser.HEADERS:
+                if buf.startswith(b"\r\n"):
+                    # 没有头
+                    index, head = 0, b""
+                else:
+                    index = buf.find(b"\r\n\r\n")
+                    if index < 0:
+                        self._check_header_size()
+                        return
+                    head = bytes(buf[:index])
+                    index += 2
+                del buf[:index + 2]
+                self._start_part(head)
+                self._state = MultipartParser.BODY
+            else:
+                buf.clear()
+
+    def _check_header_size(self):
+        if len(self._buf) > self.MAX_HEADER_SIZE:
+            raise RequestParseException(400, "Bad Request")
+
+    def _start_part(self, head:bytes):
+        headers = {}
+        for line in head.decode("utf-8", "replace").split("\r\n"):
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        # Content-Disposition: form-data; name="name of pdf"; filename="pdf-file.pdf"
+        disposition, params = cgi.parse_header(headers.get("content-disposition", ""))
+        name = params.get("name")
+        if disposition != "form-data" or not name:
             raise RequestParseException(400, "Bad Request")
-        name = name.strip("'").strip('"')
-        # 只有文件才会有这个字段
-        filename = headers.get("filename", "")
-        if not filename:
-            # 不是文件，则直接读取出里面的内容
-            self.buffer.seek(start_pos, io.SEEK_SET)
-            value = self.read_data(end_pos - start_pos).getvalue()
-            self.buffer.seek(end_pos, io.SEEK_SET)
-            return Field(name, value.decode("utf-8").strip(self.HTTP_LRE))
-        # 文件数据
-        filename = filename.strip("'").strip('"')
+        # 只有文件才会有filename
+        filename = params.get("filename")
         content_type = headers.get("content-type", "")
-        size = end_pos - start_pos - 2  # 去掉最后的\r\n
-        # 如果文件很小，没有落地，那么直接从内存读取
-        if not self.buffer.file_buffer:
-            self.buffer.seek(start_pos, io.SEEK_SET)
-            value = self.read_data(size)
-            self.buffer.seek(end_pos, io.SEEK_SET)
-            value.seek(0, io.SEEK_SET)
-            return FileField(name, filename, content_type, value, size)
+        if filename:
+            sink = self.sinks.get(name) or self.sinks.get("*") or self.default_sink
+            self._part = [name, filename, content_type, sink.open(name, filename, content_type), 0, sink]
+        else:
+            self._part = [name, filename, content_type, io.BytesIO(), 0, None]
+
+    def _write_part(self, buf:bytearray, size):
+        part = self._part
+        sink = part[5]
+        if sink is not None and sink.max_size is not None and part[4] + size > sink.max_size:
+            raise RequestParseException(413, "Request Entity Too Large")
+        with memoryview(buf) as view:
+            part[3].write(view[:size])
+        part[4] += size
+
+    def _end_part(self):
+        name, filename, content_type, fp, size, sink = self._part
+        if sink is not None:
+            field = sink.finish(fp, name, filename, content_type, size)
+            self._files.append((sink, field))
+            self.fields.append(field)
+        else:
+            self.fields.append(Field(name, fp.getvalue().decode("utf-8")))
+        self._part = None
 
-        self.buffer.seek(end_pos, io.SEEK_SET)
-        value = io.FileIO(self.buffer.filename, "rb")
-        value.seek(start_pos, io.SEEK_SET)
-        return FileField(name, filename, content_type, value, size)
+    def finish(self):
+        """
+        请求体全部写入后调用，没有结束分隔符的（请求体不完整）返回400
+        :return: 解析出来的Field和FileField
+        """
+        if self._state != MultipartParser.END:
+            raise RequestParseException(400, "Bad Request")
+        try:
+            for sink, field in self._files:
+                sink.commit(field)
+        except OSError as e:
+            logging.exception("commit upload file error:%s", e)
+            raise RequestParseException(500, "Server Error")
+        return self.fields
+
+    def close(self):
+        # 解析失败时释放已经写入的数据
+        if self._part is not None:
+            fp, sink = self._part[3], self._part[5]
+            if sink is not None:
+                sink.abort(fp)
+            elif fp is not None:
+                fp.close()
+            self._part = None
+        for sink, field in self._files:
+            sink.discard(field)
+        self._files = []
+
+
+class RateLimiter:
+    """
+    令牌桶限速器，可以在多个线程的事件循环之间共享
+    rate: 每秒允许发送的字节数
+    burst: 令牌桶的容量，即允许的突发字节数，默认等于rate
+    """
+
+    def __init__(self, rate:int, burst:int=None):
+        if rate <= 0:
+            raise ValueError("rate must be greater than 0")
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def chunk_size(self):
+        # 每次发送的大小，大约是100毫秒的流量
+        return max(4096, min(self.rate // 10, self.burst))
+
+    def _reserve(self, size):
+        # 预支令牌，令牌不足时返回需要等待的时间
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= size
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    async def consume(self, size:int):
+        delay = self._reserve(size)
+        if delay > 0:
+            await asyncio.sleep(delay)
 
 
 class HttpConfig:
@@ -882,15 +1697,35 @@ class HttpConfig:
         self.static_path = None
         self.script_path = None
         self.template_path = None
+        self.template_cache_size = 256      # 缓存编译好的模板的最大数量
+        self.template_precompile = False    # 启动时编译所有的模板
+        self.template_cache_dir = None      # 模板编译结果的磁盘缓存目录
+        self.fragment_cache_size = (1024, 1024 * 1024 * 64)  # 模板片段缓存的最大数量和内容的总长度
         self.support_static_cache = True
+        self.static_stat_ttl = 1.0          # 静态文件信息缓存的有效秒数，0表示不缓存
+        self.static_stat_cache_size = 4096  # 静态文件信息缓存的最大数量
+        self.static_memory_cache_size = (1024 * 1024 * 32, 1024 * 64)  # 静态文件内存缓存的总长度和单个文件的最大大小
+        self.support_compress = False       # 根据Accept-Encoding压缩响应内容，使用using_compress开启
+        self.compress_min_size = 1024       # 超过这个大小的响应才压缩
+        self.compress_level = 6             # 压缩等级 1-9
+        self.compress_static_max_size = 1024 * 1024     # 静态文件没有.gz文件时，超过这个大小的不压缩
         self.support_chunk = False
         self.support_range = True
+        self.max_range_count = 16       # 一个请求最多的range区域数，超过时发送整个文件
+        self.support_sendfile = True    # 静态文件使用os.sendfile发送
+        self.connection_rate_limit = None   # 每个连接发送文件的限速 字节/秒
+        self.total_rate_limit = None        # 所有连接发送文件的总限速 字节/秒
         self.max_buff_size = 1024 * 1024 * 2
+        self.max_header_size = 1024 * 64    # 请求头（包括请求行）的最大长度
+        self.max_header_count = 100         # 请求头的最大数量
         self.backlog = 1024
         self.max_thread = 2
+        self.worker_process = 1     # 工作进程数，大于1时使用多进程模式
+        self.reuse_port = True      # 多进程时每个进程使用SO_REUSEPORT各自绑定端口
         self.is_https = False
         self.is_debug_https = False
         self.ssl_cert = None
+        self.stream_server = False      # 是否使用asyncio流实现的服务
         self.runtime_global_params = {}
 
     def bind_runtime(self, name, runtime):
@@ -904,6 +1739,91 @@ class HttpConfig:
         self.is_debug_https = debug_https
         self.ssl_cert = (key_file, cert_file)
 
+    def using_prefork(self, worker_process, reuse_port=True):
+        """
+        使用多进程模式，主进程负责监控工作进程，工作进程异常退出时会重新拉起
+        :param worker_process: 工作进程数
+        :param reuse_port: 是否使用SO_REUSEPORT让每个进程各自绑定端口，系统不支持时共享主进程创建的监听socket
+        """
+        self.worker_process = worker_process
+        self.reuse_port = reuse_port
+
+    def using_stream_server(self, enable=True):
+        # 使用asyncio.start_server实现的服务，所有连接都是非阻塞的
+        self.stream_server = enable
+
+    def limit_rate(self, connection_rate=None, total_rate=None):
+        """
+        限制发送文件的带宽，不设置则不限速
+        :param connection_rate: 每个连接的速度 字节/秒
+        :param total_rate: 所有连接的总速度 字节/秒，多进程模式下平均分给每个工作进程
+        """
+        self.connection_rate_limit = connection_rate
+        self.total_rate_limit = total_rate
+
+    def limit_range(self, max_count):
+        """
+        限制range请求的区域数量，多个区域时使用multipart/byteranges发送，超过时忽略Range发送整个文件
+        :param max_count: 最多的区域数量
+        """
+        self.max_range_count = max_count
+
+    def limit_header(self, max_size=None, max_count=None):
+        """
+        限制请求头的大小，超过时返回431
+        :param max_size: 请求头（包括请求行）的最大字节数
+        :param max_count: 请求头的最大数量
+        """
+        if max_size is not None:
+            self.max_header_size = max_size
+        if max_count is not None:
+            self.max_header_count = max_count
+
+    def using_template_precompile(self, cache_dir=None):
+        """
+        启动服务时编译模板目录下的所有模板，多进程模式下在fork之前编译，工作进程直接使用
+        :param cache_dir: 编译结果保存的目录，重启后模板没有修改的直接加载，不需要重新编译
+        """
+        self.template_precompile = True
+        self.template_cache_dir = cache_dir
+
+    def set_fragment_cache(self, max_count=1024, max_length=1024 * 1024 * 64):
+        """
+        设置模板片段缓存 {% cache key ttl %} 的大小
+        :param max_count: 最多缓存的片段数量
+        :param max_length: 缓存内容的总长度
+        """
+        self.fragment_cache_size = (max_count, max_length)
+
+    def set_static_stat_cache(self, ttl=1.0, max_size=4096):
+        """
+        设置静态文件信息（路径、大小、修改时间等）的缓存
+        :param ttl: 缓存的有效秒数，文件修改后最多经过这个时间才能生效，0表示不缓存
+        :param max_size: 最多缓存的url数量
+        """
+        self.static_stat_ttl = ttl
+        self.static_stat_cache_size = max_size
+
+    def set_static_memory_cache(self, max_length=1024 * 1024 * 32, max_file_size=1024 * 64):
+        """
+        设置小的静态文件的内存缓存
+        :param max_length: 缓存的总长度，0表示不缓存
+        :param max_file_size: 不超过这个大小的文件才缓存
+        """
+        self.static_memory_cache_size = (max_length, max_file_size)
+
+    def using_compress(self, enable=True, min_size=1024, level=6, static_max_size=1024 * 1024):
+        """
+        根据请求头Accept-Encoding使用gzip或deflate压缩文本类型的响应
+        :param min_size: 超过这个大小的响应才压缩
+        :param level: 压缩等级 1-9
+        :param static_max_size: 静态文件优先使用同目录下的.gz文件，没有时第一次请求压缩后缓存在内存中，超过这个大小的不压缩
+        """
+        self.support_compress = enable
+        self.compress_min_size = min_size
+        self.compress_level = level
+        self.compress_static_max_size = static_max_size
+
     def bind_param(self, name, symbol):
         self.runtime_global_params[name] = symbol
 
@@ -913,8 +1833,14 @@ class HttpConfig:
     def script_path_root(self, path):
         self.script_path = path
 
-    def template_path_root(self, path):
+    def template_path_root(self, path, cache_size=None):
+        """
+        :param path: 模板的根目录
+        :param cache_size: 缓存编译好的模板的最大数量
+        """
         self.template_path = path
+        if cache_size is not None:
+            self.template_cache_size = cache_size
 
     def set_logger(self, logger):
         self.logger = logger
@@ -938,6 +1864,9 @@ class Response:
         self.body = io.BytesIO()
         self.version = "HTTP/1.1"
         self.keep_alive = True
+        self._stream = None     # 流式发送的响应体
+        self._chunked = False
+        self._etag = None       # None:不使用ETag，True:根据内容计算，字符串:指定的ETag
 
     def set_status(self, code, msg=""):
         self.status_code = code
@@ -966,32 +1895,163 @@ class Response:
         else:
             raise ValueError("text must be str or bytes")
 
-    def _before_write_header(self):
-        # 提供一个在写入响应头前的处理方法
-        if "Content-Type" not in self.headers:
-            self.set_header("Content-Type", "text/html; charset=utf-8")
-        if "Date" not in self.headers:
-            self.set_header("Date", Utils.to_rfc822(time.localtime()))
-        if "Content-Length" not in self.headers:
-            self.set_header("Content-Length", self.body.tell())
+    def add_vary(self, name):
+        # 在Vary中增加一个影响响应内容的请求头
+        vary = self.headers.get("Vary")
+        if not vary:
+            self.set_header("Vary", name)
+        elif name.lower() not in vary.lower():
+            self.set_header("Vary", "{0}, {1}".format(vary, name))
 
-    async def send_header(self, session):
-        if self.version == "HTTP/0.9":
+    def enable_etag(self, etag=None):
+        """
+        响应带上ETag，客户端使用If-None-Match再次请求时内容没有变化则返回304，不再发送内容
+        :param etag: 指定的ETag，例如数据的版本号；不指定时根据响应的内容计算
+        """
+        if etag is None:
+            self._etag = True
+        elif etag.startswith('"') or etag.startswith('W/"'):
+            self._etag = etag
+        else:
+            self._etag = '"{0}"'.format(etag)
+
+    def prepare(self, request):
+        """
+        发送响应前根据请求调整响应：检查ETag，对超过一定大小的文本内容进行压缩
+        """
+        if self._stream is not None:
             return
-        self._before_write_header() # 发送前提供一个处理的接口
-        # 写入响应结果
-        session.write("{0} {1} {2}\r\n".format(self.version, self.status_code, self.msg))
-        # 写入响应头
+        app = Application.ins()
+        encoding = None
+        # 处理方法自己设置了Content-Length或Content-Range的，压缩后长度不一致，不压缩
+        if app.compress_support and "Content-Encoding" not in self.headers and \
+                "Content-Length" not in self.headers and "Content-Range" not in self.headers and \
+                Utils.is_compressible(self.headers.get("Content-Type", "text/html")):
+            self.add_vary("Accept-Encoding")
+            if self.body.tell() >= app.config.compress_min_size:
+                encoding = Utils.select_encoding(request.get_header("Accept-Encoding"))
+        etag = None
+        if self._etag is not None and self.status_code == 200:
+            etag = self._etag
+            if etag is True:
+                etag = '"{0}"'.format(hashlib.sha1(self.body.getbuffer()).hexdigest())
+            if self.not_modified(request, etag, encoding):
+                return
+        if encoding:
+            self.compress(encoding, app.config.compress_level)
+        if etag:
+            # 压缩后的内容是不同的表示，使用不同的ETag
+            encoding = self.headers.get("Content-Encoding")
+            self.set_header("ETag", etag[:-1] + "-" + encoding + '"' if encoding else etag)
+
+    def not_modified(self, request, etag, encoding=None):
+        """
+        客户端If-None-Match中的ETag和内容一致时改为304，不发送内容
+        压缩的内容没有变小时不会压缩，所以和压缩前的ETag一致也可以返回304
+        """
+        if_none_match = request.get_header("If-None-Match")
+        if not if_none_match or request.method not in ("get", "head"):
+            return False
+        candidates = (etag[:-1] + "-" + encoding + '"', etag) if encoding else (etag,)
+        for candidate in candidates:
+            if Utils.etag_match(if_none_match, candidate):
+                self.set_header("ETag", candidate)
+                self.set_status(304)
+                self.body = io.BytesIO()
+                return True
+        return False
+
+    def compress(self, encoding, level=6):
+        # 压缩响应的内容，压缩后没有变小的不压缩
+        size = self.body.tell()
+        data = Utils.compress(self.body.getbuffer(), encoding, level)
+        if len(data) >= size:
+            return
+        self.body = io.BytesIO()
+        self.body.write(data)
+        self.set_header("Content-Encoding", encoding)
+
+    def write_stream(self, chunks, chunked=True):
+        """
+        流式发送响应体，每生成一块内容就发送给客户端，不需要等全部内容生成
+        :param chunks: 生成str或bytes的可迭代对象
+        :param chunked: 使用Transfer-Encoding: chunked发送；HTTP/1.0不支持，发送完成后关闭连接表示结束
+        """
+        self._stream = chunks
+        self._chunked = chunked
+        if not chunked:
+            self.keep_alive = False
+
+    def _before_write_header(self):
+        # 提供一个在写入响应头前的处理方法
+        if "Content-Type" not in self.headers:
+            self.set_header("Content-Type", "text/html; charset=utf-8")
+        if "Date" not in self.headers:
+            self.set_header("Date", Utils.http_date())
+        if self._stream is not None:
+            # 流式发送的长度未知
+            if self._chunked:
+                self.set_header("Transfer-Encoding", "chunked")
+            return
+        # 304没有响应体，Content-Length应该是原内容的长度，不发送
+        if "Content-Length" not in self.headers and self.status_code != 304:
+            self.set_header("Content-Length", self.body.tell())
+
+    def serialize_header(self):
+        # 将响应行、响应头和Cookies序列化为一块数据
+        msg = self.msg or RESPONSE_CODE_DEFINED.get(self.status_code, "Server Error")
+        lines = ["{0} {1} {2}\r\n".format(self.version, self.status_code, msg)]
         for name, value in self.headers.items():
-            session.write("{0}: {1}\r\n".format(name, value))
-        # 写入Cookies
+            lines.append("{0}: {1}\r\n".format(name, value))
         for value in self.cookies.values():
-            session.write("Set-Cookie: : {0}\r\n".format(value))
+            lines.append("Set-Cookie: {0}\r\n".format(value))
         # 头写入完成
-        session.write("\r\n")
+        lines.append("\r\n")
+        return "".join(lines).encode("utf-8")
+
+    async def send_header(self, session):
+        if self.version == "HTTP/0.9":
+            return
+        self._before_write_header() # 发送前提供一个处理的接口
+        await session.write_raw(self.serialize_header())
 
     async def send_body(self, session):
-        session.write_raw(self.body.getvalue())
+        if self._stream is not None:
+            await self._send_stream(session)
+            return
+        # 直接使用BytesIO的内存视图，避免getvalue拷贝一次
+        if self.body.tell():
+            await session.write_raw(self.body.getbuffer())
+
+    async def _send_stream(self, session):
+        # 已经write的内容作为第一块先发送
+        chunk = self.body.getvalue() if self.body.tell() else b""
+        iterator = iter(self._stream)
+        first = True
+        while True:
+            if chunk:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                if self._chunked:
+                    await session.write_raw(b"%X\r\n" % len(chunk))
+                    await session.write_raw(chunk)
+                    await session.write_raw(b"\r\n")
+                else:
+                    await session.write_raw(chunk)
+                # 第一块立即发送，后面的由write_raw攒够MAX_PENDING_SIZE再发送，减少系统调用
+                if first:
+                    first = False
+                    await session.drain()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                break
+            except Exception as e:
+                # 响应头已经发出，只能断开连接让客户端知道内容不完整
+                logging.exception("stream response error:%s", e)
+                raise RequestCloseException()
+        if self._chunked:
+            await session.write_raw(b"0\r\n\r\n")
 
     def __str__(self):
         return f"Response(status_code={self.status_code}, headers={self.headers}, body={self.body})"
@@ -1001,6 +2061,7 @@ class FileResponse(Response):
     DEFAULT = 0x0
     CHUNKED = 0x1
     RANGE = 0x2
+    MEMORY = 0x4
 
     def __init__(self):
         super().__init__()
@@ -1009,44 +2070,102 @@ class FileResponse(Response):
         self._file_size = 0
         self._using_mode = FileResponse.DEFAULT
         self._include_body = True
+        self._memory = None     # 内存中的文件 (预先序列化好的文件响应头, 文件内容)
+        self._range_end = None  # multipart/byteranges的结束分隔符
 
-    def set_file(self, filepath:str, mine_type:str):
+    def set_file(self, filepath:str, mine_type:str, file_size:int=None):
+        """
+        :param file_size: 文件大小，已经知道大小时传入，避免再次获取
+        """
         self._file_path = filepath
-        self._file_size = os.path.getsize(filepath)
+        self._file_size = os.path.getsize(filepath) if file_size is None else file_size
         self.set_header("Content-Type", mine_type)
 
+    def set_memory_file(self, header:bytes, body:bytes):
+        """
+        从内存中发送文件，不需要读取磁盘
+        :param header: 预先序列化好的文件相关的响应头，见serialize_file_header
+        :param body: 文件的内容
+        """
+        self._using_mode = FileResponse.MEMORY
+        self._memory = (header, body)
+
+    @staticmethod
+    def serialize_file_header(file_path, mine_type, file_size, encoding=None):
+        # 序列化文件相关的响应头，包括结尾的空行，和_before_write_header中设置的一致
+        lines = ["Content-Type: {0}\r\n".format(mine_type)]
+        if encoding:
+            lines.append("Content-Encoding: {0}\r\n".format(encoding))
+        lines.append("Content-Length: {0}\r\n".format(file_size))
+        lines.append("Content-Disposition: attachment; filename={0}\r\n\r\n".format(os.path.basename(file_path)))
+        return "".join(lines).encode("utf-8")
+
+    def prepare(self, request):
+        # 文件的压缩由StaticFileHandler处理，只处理没有文件的普通响应（例如404）
+        if self._file_path or self._using_mode == FileResponse.MEMORY:
+            return
+        super().prepare(request)
+
     def only_header(self):
         self._include_body = False
 
     def enable_range(self, request_range:str):
-        if not Application.ins().range_support:
+        app = Application.ins()
+        if not app.range_support:
             return
         if not self._file_path:
             raise ValueError("请先调用set_file之后调用enable_range!!!")
         ranges = Utils.read_range(request_range, self._file_size)
-        if not ranges or len(ranges) > 1:   # 先不支持multipart range请求
+        if not ranges:
+            # 416不发送文件的内容
             self.set_header("Content-Range", "bytes */%s" % (self._file_size,))
             self.set_status(416)
+            self._file_path = None
+            return
+        if len(ranges) > app.max_range_count:
+            # 区域太多，忽略Range发送整个文件，避免大量的小区域消耗服务器资源
             return
-        # 只发第一个区域
-        start, end = ranges[0]
-        read_size = end - start + 1     # 读取长度
-        self.set_header("Content-Range", "bytes %s-%s/%s" % (start, end, self._file_size))
-        self.set_header("Content-Length", read_size)
         self.set_status(206)
         self._using_mode = FileResponse.RANGE
-        self._range = [start, end]
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            read_size = end - start + 1     # 读取长度
+            self.set_header("Content-Range", "bytes %s-%s/%s" % (start, end, self._file_size))
+            self.set_header("Content-Length", read_size)
+            self._range = [start, end]
+            return
+        # 多个区域使用multipart/byteranges，每个区域前面是分隔符和区域的头
+        boundary = uuid.uuid4().hex
+        content_type = self.headers.get("Content-Type", "application/octet-stream")
+        parts = []
+        content_length = 0
+        for start, end in ranges:
+            part_header = ("\r\n--{0}\r\nContent-Type: {1}\r\nContent-Range: bytes {2}-{3}/{4}\r\n\r\n"
+                           .format(boundary, content_type, start, end, self._file_size).encode("utf-8"))
+            parts.append((part_header, start, end))
+            content_length += len(part_header) + end - start + 1
+        self._range_end = "\r\n--{0}--\r\n".format(boundary).encode("utf-8")
+        content_length += len(self._range_end)
+        self._range = parts
+        self.set_header("Content-Type", "multipart/byteranges; boundary={0}".format(boundary))
+        self.set_header("Content-Length", content_length)
 
     def enable_trunked(self):
         if Application.ins().chunk_support:
             self._using_mode = FileResponse.CHUNKED
 
     def _before_write_header(self):
+        if self._using_mode == FileResponse.MEMORY:
+            # 文件相关的响应头已经序列化好了
+            if "Date" not in self.headers:
+                self.set_header("Date", Utils.http_date())
+            return
         super()._before_write_header()
         # 对于开启了缓存的，只会发304过去，不会有body，因此不需要将Content-Length发过去，否则会导致浏览器出异常
         if not self._file_path:
             return
-        self.set_header("Content-Disposition", "attachment; filename={0}".format(os.path.basename(self._file_path)))
+        if "Content-Disposition" not in self.headers:
+            self.set_header("Content-Disposition", "attachment; filename={0}".format(os.path.basename(self._file_path)))
         # 使用chunked 发送数据，不需要设置Content-Length
         if self._using_mode == FileResponse.CHUNKED:
             self.set_header("Transfer-Encoding", "chunked")
@@ -1057,37 +2176,102 @@ class FileResponse(Response):
             self.set_header("Content-Length", self._file_size)
 
     async def write_with_chunk(self, session):
+        max_buff_size, limiters = self._send_limit(session)
+        offset = 0
         with open(self._file_path, "rb") as fp:
-            while True:
-                chunk = fp.read(Application.ins().max_buff_size)
-                if not chunk:
-                    self._send_chunk(session, b"")
-                    break
-                self._send_chunk(session, chunk)
-                await asyncio.sleep(0.1)
+            while offset < self._file_size:
+                size = min(self._file_size - offset, max_buff_size)
+                for limiter in limiters:
+                    await limiter.consume(size)
+                await session.write_raw(b"%X\r\n" % size)
+                await self._write_file(session, fp, offset, size)
+                await session.write_raw(b"\r\n")
+                offset += size
+                await session.drain()
+            await self._send_chunk(session, b"")
+
+    @staticmethod
+    def _send_limit(session):
+        """
+        获取发送文件时每次发送的大小和需要经过的限速器
+        开启限速时每次发送的数据量会减小，使得流量更平滑
+        """
+        app = Application.ins()
+        max_buff_size = app.max_buff_size
+        limiters = []
+        if app.connection_rate_limit:
+            if session.rate_limiter is None:
+                session.rate_limiter = RateLimiter(app.connection_rate_limit)
+            limiters.append(session.rate_limiter)
+        if app.rate_limiter:
+            limiters.append(app.rate_limiter)
+        for limiter in limiters:
+            max_buff_size = min(max_buff_size, limiter.chunk_size)
+        return max_buff_size, limiters
 
     @staticmethod
-    def _send_chunk(session, chunk:bytes):
+    async def _send_chunk(session, chunk:bytes):
         chunk_size = len(chunk)
-        session.write("%X\r\n" % chunk_size)
+        await session.write_raw(b"%X\r\n" % chunk_size)
         if chunk_size > 0:
-            session.write_raw(chunk)
-        session.write("\r\n")
+            await session.write_raw(chunk)
+        await session.write_raw(b"\r\n")
 
-    async def write_with_range(self, session):
-        start_pos = self._range[0]
-        size = self._range[1] - start_pos + 1
-        max_buff_size = Application.ins().max_buff_size
+    @staticmethod
+    async def _write_file(session, fp, offset, size):
+        # 发送文件中的一段数据，开启sendfile时由内核直接从文件发送到socket
+        if Application.ins().sendfile_support:
+            sent = await session.sendfile(fp, offset, size)
+        else:
+            fp.seek(offset, io.SEEK_SET)
+            data = fp.read(size)
+            sent = len(data)
+            await session.write_raw(data)
+        # 文件在发送过程中被截断，已经无法按照声明的长度发送，只能断开连接
+        if sent < size:
+            raise RequestCloseException()
+
+    async def _write_region(self, session, offset, size):
+        max_buff_size, limiters = self._send_limit(session)
         with open(self._file_path, "rb") as fp:
-            fp.seek(start_pos, io.SEEK_SET)
             while size > 0:
-                chunk = fp.read(min(size, max_buff_size))
-                size -= len(chunk)
-                session.write_raw(chunk)
-                await asyncio.sleep(0.1)
+                count = min(size, max_buff_size)
+                for limiter in limiters:
+                    await limiter.consume(count)
+                await self._write_file(session, fp, offset, count)
+                offset += count
+                size -= count
+                await session.drain()
+
+    async def write_with_range(self, session):
+        if self._range_end is None:
+            start_pos = self._range[0]
+            size = self._range[1] - start_pos + 1
+            await self._write_region(session, start_pos, size)
+            return
+        # multipart/byteranges
+        for part_header, start, end in self._range:
+            await session.write_raw(part_header)
+            await self._write_region(session, start, end - start + 1)
+        await session.write_raw(self._range_end)
+
+    def serialize_header(self):
+        header = super().serialize_header()
+        if self._using_mode == FileResponse.MEMORY:
+            # 去掉结尾的空行，接上预先序列化好的文件响应头
+            header = header[:-2] + self._memory[0]
+        return header
 
     async def send_body(self, session):
+        if not self._include_body:
+            return
+        if self._using_mode == FileResponse.MEMORY:
+            # 和响应头一起在finish时一次发送
+            await session.write_raw(memoryview(self._memory[1]))
+            return
         if not self._file_path:
+            # 没有文件的响应（例如404）发送普通的body
+            await super().send_body(session)
             return
         if self._using_mode == FileResponse.CHUNKED:
             await self.write_with_chunk(session)
@@ -1095,37 +2279,92 @@ class FileResponse(Response):
         elif self._using_mode == FileResponse.RANGE and self._range:
             await self.write_with_range(session)
             return
-        with open(self._file_path, "rb") as fp:
-            while True:
-                data = fp.read(Application.ins().max_buff_size)
-                if not data:
-                    break
-                session.write_raw(data)
-                await asyncio.sleep(0.1)
+        await self._write_region(session, 0, self._file_size)
+
+
+class RequestHeaders:
+    """
+    请求头，解析时只保存原始的字节数据，取值的时候才解码（解码后缓存）
+    名称统一使用小写
+    """
+    __slots__ = ("_raw", "_values")
+
+    def __init__(self):
+        self._raw = {}      # type: dict[str, bytes]
+        self._values = {}   # type: dict[str, str]
+
+    def add_raw(self, name:str, value:bytes):
+        # 名称需要是小写的，重复的请求头后面的覆盖前面的
+        self._raw[name] = value
+        self._values.pop(name, None)
+
+    def get_raw(self, name, default=None):
+        return self._raw.get(name, default)
+
+    def get(self, name, default=None):
+        value = self._values.get(name)
+        if value is not None:
+            return value
+        raw = self._raw.get(name)
+        if raw is None:
+            return default
+        value = self._values[name] = raw.decode("utf-8", "replace")
+        return value
+
+    def keys(self):
+        return self._raw.keys()
+
+    def items(self):
+        return [(name, self.get(name)) for name in self._raw]
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value:str):
+        name = name.lower()
+        self._raw[name] = value.encode("utf-8")
+        self._values[name] = value
+
+    def __contains__(self, name):
+        return name in self._raw
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __str__(self):
+        return str(dict(self.items()))
 
 
 class Request:
     def __init__(self):
         self.method = "get"
         self.path = "/"
-        self.headers = {}
+        self.headers = RequestHeaders()
         self.body = None        # type: Buffer or None
         self.version = "HTTP/1.1"
         self.version_number = (1, 1)
         self.cookies = {}
         self.arguments = {}
+        self.params = {}    # 路由中的路径参数
         self.files = {}     # type: dict[str, list[FileField]]
 
     def clear(self):
+        # 当客户端上传大文件的时候会触发临时落地数据，因此在请求结束后需要清楚掉这个缓存数据
         if self.files:
+            for fields in self.files.values():
+                for field in fields:
+                    field.close()
             self.files.clear()
-        # 当客户端上传大文件的时候会触发临时落地数据，因此在请求结束后需要清楚掉这个缓存数据
         if not self.body or not isinstance(self.body, Buffer):
             return
         # 清理请求的数据
-        if self.body.file_buffer:
-            self.body.file_buffer.close()
-            os.remove(self.body.filename)
+        self.body.close()
 
     def get_header(self, name):
         return self.headers.get(name.lower(), None)
@@ -1133,6 +2372,9 @@ class Request:
     def get_cookie(self, name):
         return self.cookies.get(name, None)
 
+    def get_param(self, name, default=None):
+        return self.params.get(name, default)
+
     def get_argument(self, name, default=None):
         values = self.arguments.get(name, None)
         if not values:
@@ -1149,39 +2391,139 @@ class Session:
     # 默认接收数据大小
     DEFAULT_RECV_SIZE = 1024 * 1024
     DEFAULT_MEMORY_SIZE = 1024 * 1024 * 100
+    # 每次从socket接收数据放入读缓冲区的大小
+    RECV_BUFFER_SIZE = 1024 * 64
+    # 单行的最大长度
+    MAX_LINE_SIZE = 1024 * 64
+    # 待发送的数据超过这个大小就立即发送，否则等到flush或finish时合并发送
+    MAX_PENDING_SIZE = 1024 * 64
+    # 单次sendmsg最多提交的缓冲区数量
+    MAX_IOV_COUNT = 512
 
     def __init__(self, client_sock:socket.socket):
         super().__init__()
         self.client_sock = client_sock
         self.session_id = uuid.uuid4().hex
         self.closed = False
-        self.read_fd = client_sock.makefile("rb")
-        self.write_fd = client_sock.makefile("wb")
+        self._rbuf = bytearray()    # 已经接收但还没有读取的数据
         self.raw_buffer = Buffer(self.session_id, self.DEFAULT_MEMORY_SIZE)
+        self._pending = []      # 等待发送的数据
+        self._pending_size = 0
+        self.rate_limiter = None    # 当前连接的限速器 type: RateLimiter or None
 
     @property
     def remote_ip(self):
         return self.client_sock.getpeername()[0]
 
-    def read(self, size):
-        # 读取指定大小字节的数据
+    async def _recv_raw(self, size):
+        # 从连接接收最多size字节的数据
+        # 非阻塞接收，没有数据时在事件循环中等待socket可读，慢速的客户端不会占住线程内的其他会话
+        sock = self.client_sock
+        sock.setblocking(False)
+        try:
+            while True:
+                try:
+                    return sock.recv(size)
+                except (BlockingIOError, InterruptedError, ssl.SSLWantReadError):
+                    await self._wait_readable()
+                except ssl.SSLWantWriteError:
+                    await self._wait_writable()
+        finally:
+            self._restore_blocking()
+
+    async def _recv(self):
+        # 接收一次数据放入读缓冲区，连接已经关闭时返回False
+        data = await self._recv_raw(self.RECV_BUFFER_SIZE)
+        if not data:
+            self.closed = True
+            return False
+        self._rbuf += data
+        return True
+
+    def has_buffered_data(self):
+        # 是否还有已经接收但没有处理的数据，例如客户端使用pipelining连续发送的请求
+        return len(self._rbuf) > 0
+
+    async def read(self, size):
+        # 读取最多指定大小字节的数据，优先从读缓冲区中取
         try:
-            data = self.read_fd.read(size)
+            if self._rbuf:
+                data = bytes(self._rbuf[:size])
+                del self._rbuf[:size]
+                return data
+            data = await self._recv_raw(min(size, self.DEFAULT_RECV_SIZE))
             if not data:
                 self.closed = True
             return data
+        except (ConnectionError, OSError):
+            self.closed = True
         except Exception as e:
             logging.exception("Error reading data: %s", e)
         return None
 
-    def read_line(self):
+    async def read_head(self, max_size):
+        """
+        读取完整的请求头：请求行和所有的请求头，到空行为止。HTTP/0.9的请求只有请求行
+        :param max_size: 请求头的最大长度，超过时返回431
+        :return: 请求头的原始数据，包括结尾的空行；连接已经关闭返回None
+        """
+        rbuf = self._rbuf
+        line_end = -1
+        search = 0
+        try:
+            while True:
+                if line_end < 0:
+                    # 忽略请求前面多余的空行
+                    while rbuf.startswith(b"\r\n"):
+                        del rbuf[:2]
+                    line_end = rbuf.find(b"\r\n")
+                    if line_end >= 0:
+                        # HTTP/0.9 请求行只有方法和路径，后面没有请求头
+                        if len(rbuf[:line_end].split()) == 2:
+                            head = bytes(rbuf[:line_end + 2])
+                            del rbuf[:line_end + 2]
+                            return head
+                        search = line_end
+                if line_end >= 0:
+                    index = rbuf.find(b"\r\n\r\n", search)
+                    if 0 <= index <= max_size:
+                        head = bytes(rbuf[:index + 4])
+                        del rbuf[:index + 4]
+                        return head
+                    search = max(len(rbuf) - 3, search)
+                if len(rbuf) > max_size:
+                    raise RequestParseException(431, "Request Header Fields Too Large")
+                if not await self._recv():
+                    return None
+        except RequestParseException:
+            raise
+        except (ConnectionError, OSError):
+            self.closed = True
+        except Exception as e:
+            logging.exception("Error reading head: %s", e)
+        return None
+
+    async def read_line(self):
         # 读取一行数据
         try:
-            line = self.read_fd.readline()
-            if not line:
-                self.closed = True
+            start = 0
+            while True:
+                index = self._rbuf.find(b"\n", start)
+                if index >= 0:
+                    line = self._rbuf[:index + 1]
+                    del self._rbuf[:index + 1]
+                    return line.decode()
+                if len(self._rbuf) > self.MAX_LINE_SIZE:
+                    return None
+                start = len(self._rbuf)
+                if not await self._recv():
+                    break
+            # 连接关闭，返回剩余的不完整的行
+            if not self._rbuf:
                 return None
-            return line.decode()
+            line = self._rbuf.decode()
+            self._rbuf.clear()
+            return line
         except socket.error as e:
             if e.errno == 10053:
                 pass
@@ -1189,31 +2531,148 @@ class Session:
             logging.exception("Error reading line: %s", e)
         return None
 
-    def write(self, text:str):
+    async def write(self, text:str):
+        await self.write_raw(text.encode("utf-8"))
+
+    async def write_raw(self, raw:bytes):
+        # 数据先放入待发送列表，攒够一定大小或者调用flush时一次发送出去
         if self.closed:
             raise RequestCloseException()
+        self._pending.append(raw)
+        self._pending_size += len(raw)
+        if self._pending_size >= self.MAX_PENDING_SIZE:
+            await self.flush()
+
+    def _take_pending(self):
+        buffers = self._pending
+        self._pending = []
+        self._pending_size = 0
+        return buffers
+
+    async def flush(self):
+        # 发送所有待发送的数据
+        if not self._pending:
+            return
         try:
-            self.write_fd.write(text.encode("utf-8"))
-            self.write_fd.flush()
+            await self._send_buffers(self._take_pending())
         except socket.error as e:
             if e.errno == 10053:
                 self.closed = True
+            else:
+                raise
+
+    async def drain(self):
+        # 发送待发送的数据，并让出一次事件循环，使同一线程内的其他会话有机会执行
+        await self.flush()
+        await asyncio.sleep(0)
+
+    async def _send_buffers(self, buffers):
+        # 使用sendmsg一次系统调用发送多个缓冲区（writev）
+        # socket缓冲区满时不阻塞线程，而是在事件循环中等待socket可写
+        sock = self.client_sock
+        use_sendmsg = hasattr(sock, "sendmsg") and not isinstance(sock, ssl.SSLSocket)
+        if not use_sendmsg and len(buffers) > 1:
+            # ssl的socket不支持sendmsg，合并后发送
+            buffers = [b"".join(buffers)]
+        views = [memoryview(buf).cast("B") for buf in buffers]
+        sock.setblocking(False)
+        try:
+            while views:
+                try:
+                    if use_sendmsg:
+                        sent = sock.sendmsg(views[:self.MAX_IOV_COUNT])
+                    else:
+                        sent = sock.send(views[0])
+                except (BlockingIOError, InterruptedError, ssl.SSLWantWriteError):
+                    await self._wait_writable()
+                    continue
+                except ssl.SSLWantReadError:
+                    # ssl重新协商时发送也需要先读取
+                    await self._wait_readable()
+                    continue
+                # 去掉已经发送完成的缓冲区，部分发送的截取剩余部分
+                index = 0
+                while index < len(views) and sent >= views[index].nbytes:
+                    sent -= views[index].nbytes
+                    index += 1
+                del views[:index]
+                if sent and views:
+                    views[0] = views[0][sent:]
+        finally:
+            self._restore_blocking()
 
-    def write_raw(self, raw:bytes):
+    async def _wait_writable(self):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        fd = self.client_sock.fileno()
+        loop.add_writer(fd, lambda: waiter.done() or waiter.set_result(None))
+        try:
+            await waiter
+        finally:
+            loop.remove_writer(fd)
+
+    async def _wait_readable(self):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        fd = self.client_sock.fileno()
+        loop.add_reader(fd, lambda: waiter.done() or waiter.set_result(None))
+        try:
+            await waiter
+        finally:
+            loop.remove_reader(fd)
+
+    def _restore_blocking(self):
+        # 其他操作（例如ssl握手）仍然使用阻塞模式，读取和发送结束后切换回来
+        try:
+            self.client_sock.setblocking(True)
+        except OSError:
+            self.closed = True
+
+    async def sendfile(self, fp, offset, count):
+        """
+        发送文件中的一段数据
+        普通的socket使用os.sendfile由内核直接从文件发送到socket，不需要读入Python内存；
+        ssl的socket无法使用sendfile，读取后再发送。
+        :param fp: 以二进制方式打开的文件对象
+        :param offset: 文件中的起始位置
+        :param count: 发送的字节数
+        :return: 实际发送的字节数
+        """
+        await self.flush()
         if self.closed:
             raise RequestCloseException()
         try:
-            self.write_fd.write(raw)
-            self.write_fd.flush()
+            if self.can_sendfile():
+                # 非阻塞模式下由事件循环等待socket可写，慢速的客户端不会占住线程
+                self.client_sock.setblocking(False)
+                try:
+                    loop = asyncio.get_running_loop()
+                    return await loop.sock_sendfile(self.client_sock, fp, offset, count)
+                finally:
+                    self._restore_blocking()
+            fp.seek(offset, io.SEEK_SET)
+            sent = 0
+            while sent < count:
+                data = fp.read(min(count - sent, self.DEFAULT_RECV_SIZE))
+                if not data:
+                    break
+                await self._send_buffers([data])
+                sent += len(data)
+            return sent
         except socket.error as e:
             if e.errno == 10053:
                 self.closed = True
+                raise RequestCloseException()
+            raise
 
-    def finish(self):
+    def can_sendfile(self):
+        return hasattr(os, "sendfile") and not isinstance(self.client_sock, ssl.SSLSocket)
+
+    async def finish(self):
         if self.closed:
             raise RequestCloseException()
         try:
-            self.write_fd.flush()
+            await self.flush()
         except Exception:
             raise RequestCloseException()
 
@@ -1227,11 +2686,72 @@ class Session:
             logging.exception("Error closing session: %s", e)
 
 
+class StreamSession(Session):
+    """ 基于asyncio流的会话，读写都是非阻塞的，等待数据时会让出事件循环 """
+
+    def __init__(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.client_sock = writer.get_extra_info("socket")
+        self.session_id = uuid.uuid4().hex
+        self.closed = False
+        self._rbuf = bytearray()
+        self._pending = []
+        self._pending_size = 0
+        self.rate_limiter = None
+
+    @property
+    def remote_ip(self):
+        peer = self.writer.get_extra_info("peername")
+        return peer[0] if peer else None
+
+    async def _recv_raw(self, size):
+        # 从流中读取，没有数据时让出事件循环
+        return await self.reader.read(size)
+
+    async def flush(self):
+        # 待发送的数据一次交给transport，然后等待缓冲区可写
+        if not self._pending:
+            return
+        if self.writer.is_closing():
+            self.closed = True
+            raise RequestCloseException()
+        self.writer.writelines(self._take_pending())
+        try:
+            await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.closed = True
+
+    async def drain(self):
+        # flush会等待transport的写缓冲区降到水位线以下，这里就是背压
+        await self.flush()
+
+    async def sendfile(self, fp, offset, count):
+        # 由事件循环发送文件，普通连接使用os.sendfile，ssl连接会自动回退为读取后发送
+        await self.flush()
+        if self.closed:
+            raise RequestCloseException()
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.sendfile(self.writer.transport, fp, offset, count, fallback=True)
+        except (ConnectionError, OSError):
+            self.closed = True
+            raise RequestCloseException()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.writer.close()
+        except Exception as e:
+            logging.exception("Error closing session: %s", e)
+
+
 class RequestParseException(Exception):
-    def __init__(self, code, msg):
+    def __init__(self, code, msg, headers=None):
         super().__init__()
         self.code = code
         self.msg = msg
+        self.headers = headers      # 需要额外返回给客户端的响应头
         
 
 class RequestCloseException(Exception):
@@ -1246,6 +2766,7 @@ class SessionHandler:
         self.session = session
         self.request = Request()
         self.close_connection = True
+        self._route = None      # 匹配到的路由 (HandlerDispatch, 路径参数)
 
     async def do_handler(self):
         # 处理当前session的请求
@@ -1255,28 +2776,36 @@ class SessionHandler:
         except RequestCloseException:
             self.close_connection = True
         except RequestParseException as e:
-            await self.do_default_response(e.code, e.msg)
+            await self.do_default_response(e.code, e.msg, e.headers)
 
         try:
             self.request.clear()
         except Exception as e:
             logging.exception("request clear error:%s", e)
 
+    def match_route(self):
+        # 解析请求体时需要根据路由选择上传文件的UploadSink，此时还没有去掉url参数，匹配的结果缓存下来给do_method使用
+        if self._route is None:
+            self._route = Application.ins().match_route(self.request.path.partition("?")[0])
+        return self._route
+
     async def do_method(self):
         route_path = self.request.path
         method_name = self.request.method
-        handler_cls = Application.ins().match_route(route_path)
+        dispatch, params = self.match_route()
         logging.debug("Session:%s request url:%s method:%s", self.session.session_id, route_path, method_name)
-        if handler_cls is None or not issubclass(handler_cls, BaseRequestHandler):
+        if dispatch is None:
             logging.error("request url:%s not found", route_path)
             raise RequestParseException(400, "Bad Request")
-        handler = handler_cls(self.session, self.request)
-        if not hasattr(handler, method_name):
-            raise RequestParseException(405, "Method Not Allowed")
-        method = getattr(handler, method_name)
-        if not callable(method):
-            raise RequestParseException(405, "Method Not Allowed")
-        method()
+        method = dispatch.methods.get(method_name)
+        if method is None:
+            raise RequestParseException(405, "Method Not Allowed", {"Allow": dispatch.allow})
+        self.request.params = params
+        handler = dispatch.handler_cls(self.session, self.request)
+        result = method(handler)
+        # 处理方法可以是async def，等待的时候当前线程可以处理其他的请求
+        if result is not None and inspect.isawaitable(result):
+            await result
         await self.do_response(handler.response)
 
     async def do_response(self, response:Response):
@@ -1284,6 +2813,7 @@ class SessionHandler:
         if not isinstance(response, Response):
             raise RequestParseException(500, "Server Error")
         try:
+            response.prepare(self.request)
             if self.close_connection or (not response.keep_alive):  # 如果设置不保持链接，则也关闭
                 self.close_connection = True
                 response.set_header("Connection", "close")
@@ -1291,7 +2821,7 @@ class SessionHandler:
                 response.set_header("Connection", "keep-alive")
             await response.send_header(self.session)
             await response.send_body(self.session)
-            self.session.finish()
+            await self.session.finish()
         except RequestCloseException:
             self.close_connection = True
         except socket.error as e:
@@ -1299,106 +2829,130 @@ class SessionHandler:
         except Exception as e:
             logging.exception("Error sending response: %s", e)
 
-    async def do_default_response(self, code, message=""):
+    async def do_default_response(self, code, message="", headers=None):
         # 处理响应
         self.close_connection = True
         if self.request.version == "HTTP/0.9":
             return
-        self.session.write("{0} {1} {2}\r\n".format(self.request.version, code, RESPONSE_CODE_DEFINED.get(code, "Server Error")))
-        self.session.write("Content-Type: text/html; charset=utf-8\r\n")
-        self.session.write("Date: {0}\r\n".format(Utils.to_rfc822(time.localtime())))
+        lines = ["{0} {1} {2}\r\n".format(self.request.version, code, RESPONSE_CODE_DEFINED.get(code, "Server Error")),
+                 "Content-Type: text/html; charset=utf-8\r\n",
+                 "Date: {0}\r\n".format(Utils.http_date())]
         if self.close_connection:
-            self.session.write("Connection: close\r\n")
+            lines.append("Connection: close\r\n")
         else:
-            self.session.write("Connection: keep-alive\r\n")
-        if message:
-            self.session.write("Content-Length: {0}\r\n".format(len(message)))
-        self.session.write("\r\n")
-        self.session.write(message)
+            lines.append("Connection: keep-alive\r\n")
+        if headers:
+            for name, value in headers.items():
+                lines.append("{0}: {1}\r\n".format(name, value))
+        body = message.encode("utf-8")
+        if body:
+            lines.append("Content-Length: {0}\r\n".format(len(body)))
+        lines.append("\r\n")
+        if self.request.method == "head":
+            body = b""
+        await self.session.write_raw("".join(lines).encode("utf-8") + body)
+        await self.session.finish()
 
     async def do_parse(self):
-        # 解析请求头
-        await self.parse_method()
+        # 一次读取完整的请求头，再按行解析
+        head = await self.session.read_head(Application.ins().max_header_size)
+        if not head:
+            raise RequestCloseException()
+        lines = head.split(b"\r\n")
+        self.parse_method(lines[0])
         # 非HTTP/0.9的需要解析请求头和请求体
         if self.request.version != "HTTP/0.9":
-            await self.parse_header()
+            self.parse_header(lines[1:])
             # post 才有请求体
             if self.request.method == "post":
                 await self.parse_body()
+            elif self.has_body():
+                # 其他方法不处理请求体，请求体留在连接上会被当作下一个请求，因此不复用连接
+                self.close_connection = True
         # 最后解析参数，因为post的参数在body里面，需要先处理body
         self.do_parse_args()
         if not self.close_connection:
-            # POST请求的链接先不复用
-            if self.request.method == "post":
-                self.close_connection = True
-                return
             # 客户端没有提供keep-alive的也不复用
             keep_alive = self.request.get_header("Connection")
             if keep_alive and keep_alive.lower() == "close":
                 self.close_connection = True
                 return
 
-    async def parse_method(self):
+    def parse_method(self, line:bytes):
         # 解析请求行  （Request Line）：
         # 方法：如 GET、POST、PUT、DELETE等，指定要执行的操作。
         # 请求 URI（统一资源标识符）：请求的资源路径，通常包括主机名、端口号（如果非默认）、路径和查询字符串。
         # HTTP 版本：如 HTTP/1.1 或 HTTP/2。
-        line = self.session.read_line()
-        if not line or not line.endswith(self.HTTP_LRE):
-            raise RequestCloseException()
         params = line.split()
         params_size = len(params)
-        # HTTP/0.9
-        if params_size == 2:
+        if params_size == 3:
+            method, path, version = params
+        elif params_size == 2:
+            # HTTP/0.9
             method, path = params
-            if method.upper() != "GET":
+            if method.upper() != b"GET":
                 raise RequestParseException(400, "Bad Request")
-            version = "HTTP/0.9"
-        elif params_size == 3:
-            method, path, version = params
+            version = b"HTTP/0.9"
         else:
             raise RequestParseException(400, "Bad Request")
-        # 检查客户端的HTTP版本
-        if version[0:5] != "HTTP/":
-            raise RequestParseException(400, "Bad Request")
-        base_version_number = version.split('/', 1)[1]
-        version_number = base_version_number.split(".")
-        if len(version_number) != 2:
-            raise RequestParseException(400, "Bad Request")
-        version_number = int(version_number[0]), int(version_number[1])
+        # 检查客户端的HTTP版本，常见的版本直接比较
+        if version == b"HTTP/1.1":
+            version_number = (1, 1)
+        elif version == b"HTTP/1.0":
+            version_number = (1, 0)
+        else:
+            if version[0:5] != b"HTTP/":
+                raise RequestParseException(400, "Bad Request")
+            version_number = version[5:].split(b".")
+            if len(version_number) != 2 or not version_number[0].isdigit() or not version_number[1].isdigit():
+                raise RequestParseException(400, "Bad Request")
+            version_number = int(version_number[0]), int(version_number[1])
         # 版本大于等于HTTP/1.1时，支持持续链接
         if version_number >= (1, 1):
             self.close_connection = False
         # 目前不支持http/2的版本
         if version_number >= (2, 0):
             raise RequestParseException(400, "Bad Request")
-        self.request.version = version.strip()
-        self.request.method = method.lower()
+        self.request.version = version.decode("latin-1")
+        self.request.method = method.lower().decode("latin-1")
         self.request.version_number = version_number
-        self.request.path = urllib.parse.unquote(path)
+        self.request.path = urllib.parse.unquote(path.decode("utf-8", "replace"))
 
-    async def parse_header(self):
+    def parse_header(self, lines):
         # 解析请求头Request Headers）：
         # 包含了客户端环境信息、请求体的大小（如果有）、客户端支持的压缩类型等。
         # 常见的请求头包括Host、User-Agent、Accept、Accept-Encoding、Content-Length等。
-        while True:
-            line = self.session.read_line()
-            if not line or not line.endswith(self.HTTP_LRE):
-                raise RequestParseException(400, "Bad Request")
-            if line == self.HTTP_LRE:   # 请求头和请求体之间的分隔符，表示请求头的结束。
+        # 请求头的值保存原始字节，使用时才解码
+        headers = self.request.headers
+        max_count = Application.ins().max_header_count
+        count = 0
+        for line in lines:
+            if not line:    # 请求头和请求体之间的分隔符，表示请求头的结束。
                 break
-            index = line.find(":")
-            if index < 0:
+            count += 1
+            if count > max_count:
+                raise RequestParseException(431, "Request Header Fields Too Large")
+            name, sep, value = line.partition(b":")
+            if not sep:
                 raise RequestParseException(400, "Bad Request")
-            key = line[0:index].strip().lower()
-            value = line[index + 1:].strip()
-            self.request.headers[key] = value
+            headers.add_raw(name.strip().lower().decode("latin-1"), value.strip())
         # 解析出Cookie
         self.do_parse_cookies()
 
+    def has_body(self):
+        content_length = self.request.get_header("Content-Length")
+        if content_length and content_length != "0":
+            return True
+        return self.request.get_header("Transfer-Encoding") is not None
+
     async def parse_body(self):
         # 解析请求体
         # 在某些类型的HTTP请求（如 POST 和 PUT）中，请求体包含要发送给服务器的数据。
+        boundary = self.get_multipart_boundary()
+        if boundary:
+            # multipart/form-data 一边接收一边解析，不保存整个请求体
+            await self.parse_multipart_body(boundary)
+            return
         content_length = self.request.get_header("Content-Length")
         if content_length:  # 前端在请求头里面指定了请求体的大小
             content_length = int(content_length)
@@ -1416,45 +2970,66 @@ class SessionHandler:
                     raise RequestParseException(400, "Bad Request")
                 buffer.flip()
                 self.request.body = buffer
+            elif self.request.version_number >= (1, 1):
+                # HTTP/1.1 没有Content-Length也不是chunked的请求没有请求体
+                buffer = Buffer(self.session.session_id)
+                buffer.flip()
+                self.request.body = buffer
             else:
-                # 都没有那么就按行读取到结束
+                # 都没有那么就按行读取到结束，读取到连接关闭，因此也不能复用连接
+                self.close_connection = True
                 buffer = await self.read_body()
                 if not buffer or not isinstance(buffer, Buffer):
                     raise RequestParseException(400, "Bad Request")
                 buffer.flip()
                 self.request.body = buffer
 
-    async def read_chunked(self):
-        # 读取Transfer-Encoding: chunked的请求体
-        buffer = Buffer(self.session.session_id)
+    async def read_chunked(self, buffer=None):
+        """
+        读取Transfer-Encoding: chunked的请求体
+        :param buffer: 写入的对象，需要有write方法，默认写入新的Buffer
+        """
+        if buffer is None:
+            buffer = Buffer(self.session.session_id)
         while True:
-            chunk_size = self.session.read_line()
+            chunk_size = await self.session.read_line()
             if not chunk_size or not chunk_size.endswith(self.HTTP_LRE):
                 raise RequestParseException(400, "Bad Request")
             chunk_size = int(chunk_size.strip(), 16)
             if chunk_size == 0:
+                await self.session.read_line()  # 最后的空行
                 return buffer
-            data = self.session.read(chunk_size)
-            if not data:
-                raise RequestParseException(400, "Bad Request")
-            buffer.write(data)
+            while chunk_size > 0:
+                data = await self.session.read(chunk_size)
+                if not data:
+                    raise RequestParseException(400, "Bad Request")
+                buffer.write(data)
+                chunk_size -= len(data)
+            await self.session.read_line()  # 每个chunk数据后面的\r\n
 
-    async def read_content(self, content_length:int):
-        # 读取Content-Length的请求体
-        buffer = Buffer(self.session.session_id)
+    async def read_content(self, content_length:int, buffer=None):
+        """
+        读取Content-Length的请求体
+        :param buffer: 写入的对象，需要有write方法，默认写入新的Buffer
+        """
+        if buffer is None:
+            buffer = Buffer(self.session.session_id)
         while content_length > 0:
-            chunk = self.session.read(content_length)
+            chunk = await self.session.read(content_length)
             if not chunk:
                 break
             buffer.write(chunk)
             content_length -= len(chunk)
+        # 请求体没有读取完整，连接上的数据已经不可信，不能再复用
+        if content_length > 0:
+            self.close_connection = True
         return buffer
 
     async def read_body(self):
         # 读取其他的请求体
         buffer = Buffer(self.session.session_id)
         while True:
-            line = self.session.read_line()
+            line = await self.session.read_line()
             if not line:
                 break
             buffer.write(line.encode())
@@ -1491,24 +3066,34 @@ class SessionHandler:
             return
         # 解析表单参数
         # application/x-www-form-urlencoded 格式 与URL参数一样
-        # multipart/form-data 格式则比较特殊
+        # multipart/form-data 格式在接收请求体的时候已经解析了，见parse_multipart_body
         # Content-Type: text/html; charset=utf-8
-        # Content-Type: multipart/form-data; boundary=something
         content_type = self.request.get_header("Content-Type")
         if not content_type:
             return
         ctype, params = cgi.parse_header(content_type)
-        if ctype == "multipart/form-data":
-            boundary = params.get("boundary")
-            if not boundary:
-                return
-            self.parse_multipart_form_data(buffer, boundary)
-        elif ctype == "application/x-www-form-urlencoded":
+        if ctype == "application/x-www-form-urlencoded":
             # 这种格式的请求体和URL参数一样 因此不会有太大的数据量，直接读取操作
             args = urllib.parse.parse_qs(buffer.get_value().decode(), keep_blank_values=True)
             self.request.arguments.update(args)
 
-    def parse_multipart_form_data(self, buffer:Buffer, boundary):
+    def get_multipart_boundary(self):
+        # 请求体是multipart/form-data时返回分隔符，否则返回None
+        # Content-Type: multipart/form-data; boundary=something
+        content_type = self.request.get_header("Content-Type")
+        if not content_type:
+            return None
+        ctype, params = cgi.parse_header(content_type)
+        if ctype != "multipart/form-data":
+            return None
+        boundary = params.get("boundary")
+        if not boundary:
+            return None
+        if boundary.startswith('"') and boundary.endswith('"'):
+            boundary = boundary[1:-1]
+        return boundary.encode("utf-8")
+
+    async def parse_multipart_body(self, boundary:bytes):
         # # 请求头 - 这个是必须的，需要指定Content-Type为multipart/form-data，指定唯一边界值
         # Content-Type: multipart/form-data; boundary=${Boundary}
         #
@@ -1529,15 +3114,22 @@ class SessionHandler:
         #
         # text encoded in UTF-8
         # --${Boundary}--
-        boundary = boundary.encode("utf-8")
-        if boundary.startswith(b'"') and boundary.endswith(b'"'):
-            boundary = boundary[1:-1]
-        # multipart/form-data流式解析类，解决上传大文件用内存处理会崩的问题。
-        # 客户端上传的大文件时，服务器会有一个临时的缓存文件接受内容，通过self.request.files里面的FileField对象进行存储到指定的地方
-        # 如果没有调用存储，那么本次响应结束后，缓存数据会删除
-        multipart_parser = MultipartParser(buffer, boundary)
-        parts = multipart_parser.parse()
-        for field in parts:
+        # 接收到的数据直接交给解析器，每个文件写入路由声明的UploadSink，没有声明的写入自己的Buffer，大文件落地到临时文件，
+        # 通过self.request.files里面的FileField对象进行存储到指定的地方，如果没有调用存储，那么本次响应结束后，缓存数据会删除
+        dispatch, _ = self.match_route()
+        parser = MultipartParser(boundary, dispatch.upload_sinks if dispatch else None)
+        try:
+            content_length = self.request.get_header("Content-Length")
+            tc = self.request.get_header("Transfer-Encoding")
+            if content_length:
+                await self.read_content(int(content_length), parser)
+            elif tc and tc.lower() == "chunked":
+                await self.read_chunked(parser)
+            fields = parser.finish()
+        except BaseException:
+            parser.close()
+            raise
+        for field in fields:
             if isinstance(field, Field):
                 self.request.arguments.setdefault(field.name, []).append(field.value)
             elif isinstance(field, FileField):
@@ -1545,6 +3137,8 @@ class SessionHandler:
 
 
 class BaseRequestHandler:
+    upload_sinks = None     # 上传文件的字段名 -> UploadSink，"*"匹配其他所有的文件字段
+
     def __init__(self, session:Session, request:Request):
         self.session = session
         self.request = request
@@ -1618,13 +3212,21 @@ class RequestHandler(BaseRequestHandler):
         :param kwargs: 渲染模板中的参数列表
         :return:
         """
-        filename = os.path.join(Application.ins().template_path, file)
-        if not os.path.exists(filename):
-            raise FileExistsError("{0} not found".format(filename))
-        if not os.path.isfile(filename):
-            raise FileNotFoundError("{0} not file".format(filename))
-        with open(filename, "r", encoding="utf-8") as fp:
-            self.render_string(fp.read(), filename, **kwargs)
+        template = Application.ins().template_loader.load(file)
+        if self.ui:
+            kwargs.setdefault("_tt_modules", self.ui)
+        self.write(template.generate(**kwargs))
+
+    def render_stream(self, file, **kwargs):
+        """
+        流式渲染模板，渲染出一部分就发送一部分（HTTP/1.1使用chunked），适合很大的页面
+        :param file: 模板文件名，模板的根路径通过template_path_root设置
+        :param kwargs: 渲染模板中的参数列表
+        """
+        template = Application.ins().template_loader.load(file)
+        if self.ui:
+            kwargs.setdefault("_tt_modules", self.ui)
+        self.response.write_stream(template.stream(**kwargs), self.request.version_number >= (1, 1))
 
     def render_string(self, html, name, **kwargs):
         """
@@ -1638,6 +3240,195 @@ class RequestHandler(BaseRequestHandler):
         self.write(t.generate(**kwargs))
 
 
+class StaticFileInfo:
+    # 静态文件的信息
+    def __init__(self, path, file_stat:os.stat_result, gzip_stat:os.stat_result=None):
+        self.path = path
+        self.size = file_stat.st_size
+        self.mtime = file_stat.st_mtime
+        self.last_modified = Utils.http_date(file_stat.st_mtime)
+        self.mime_type = Utils.get_file_mime_type(path)
+        self.etag = '"{0:x}-{1:x}"'.format(file_stat.st_mtime_ns, file_stat.st_size)
+        # 预先压缩好的.gz文件，比原文件旧的不使用
+        self.gzip_path = None
+        self.gzip_size = 0
+        self.gzip_mtime = None
+        self.gzip_etag = '"{0:x}-{1:x}-gzip"'.format(file_stat.st_mtime_ns, file_stat.st_size)
+        if gzip_stat is not None and gzip_stat.st_mtime >= file_stat.st_mtime:
+            self.gzip_path = path + ".gz"
+            self.gzip_size = gzip_stat.st_size
+            self.gzip_mtime = gzip_stat.st_mtime
+            self.gzip_etag = '"{0:x}-{1:x}-gz"'.format(gzip_stat.st_mtime_ns, gzip_stat.st_size)
+
+    def __str__(self):
+        return f"StaticFileInfo(path={self.path}, size={self.size}, last_modified={self.last_modified})"
+
+
+class StaticFileCache:
+    """
+    静态文件信息的缓存，以请求的url路径为key，保存解析后的文件路径、大小、修改时间等信息
+    缓存的信息在ttl秒内直接使用，过期后重新获取，文件不存在的结果也会缓存
+    缓存的数量超过max_size时淘汰最久没有使用的
+    """
+
+    def __init__(self, root, ttl=1.0, max_size=4096):
+        self.root = root
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()     # url路径 -> (过期时间, StaticFileInfo)
+        self._lock = threading.Lock()
+
+    def get(self, url_path):
+        """ 获取url路径对应的文件信息，文件不存在返回None """
+        if self.ttl > 0:
+            with self._lock:
+                item = self._items.get(url_path)
+                if item is not None and item[0] > time.monotonic():
+                    self._items.move_to_end(url_path)
+                    self.hits += 1
+                    return item[1]
+                self.misses += 1
+        info = self.resolve(url_path)
+        if self.ttl > 0:
+            with self._lock:
+                self._items[url_path] = (time.monotonic() + self.ttl, info)
+                self._items.move_to_end(url_path)
+                while len(self._items) > self.max_size:
+                    self._items.popitem(last=False)
+        return info
+
+    def resolve(self, url_path):
+        """ 将url路径解析成文件的路径，并获取文件的信息 """
+        # 对url进行解码，有可能有带空格的文件之类的
+        path = urllib.parse.unquote(url_path)
+        if not self.root or not path.startswith("/static/"):
+            return None
+        path = path[len("/static/"):]
+        url_route_path = path.lstrip("/")
+        file_path = os.path.join(self.root, url_route_path)
+        # 这里一定要严格检查资源路径，否则存在服务器被【路径遍历攻击】的风险
+        # 请求人员可以/static/../../../../../etc/passwd 获取全部用户信息
+        abs_file_path = os.path.abspath(file_path)
+        if not abs_file_path.startswith(self.root):
+            return None
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        gzip_stat = None
+        if Application.ins().compress_support and Utils.is_compressible(Utils.get_file_mime_type(file_path)):
+            try:
+                gzip_stat = os.stat(file_path + ".gz")
+                if not stat.S_ISREG(gzip_stat.st_mode):
+                    gzip_stat = None
+            except OSError:
+                pass
+        return StaticFileInfo(file_path, file_stat, gzip_stat)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"count": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+class StaticMemoryCache:
+    """
+    小的静态文件的内存缓存，保存文件内容和预先序列化好的文件响应头，命中时不需要读取磁盘
+    可以压缩的文件还会缓存gzip压缩后的内容，有.gz文件的直接读取.gz文件，没有的在第一次请求时压缩
+    文件的修改时间或大小变化后重新读取，缓存的总长度超过max_length时淘汰最久没有使用的文件
+    """
+
+    def __init__(self, max_length=1024 * 1024 * 32, max_file_size=1024 * 64, max_compress_size=1024 * 1024):
+        self.max_length = max_length
+        self.max_file_size = max_file_size  # 超过这个大小的文件不缓存
+        self.max_compress_size = max_compress_size  # 没有.gz文件时，超过这个大小的文件不压缩
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()     # (文件路径, 压缩方式) -> (文件版本, 响应头, 文件内容)
+        self._length = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _version(info:StaticFileInfo):
+        return info.mtime, info.size, info.gzip_mtime, info.gzip_size
+
+    def cacheable(self, info:StaticFileInfo, encoding=None):
+        if self.max_length <= 0:
+            return False
+        if encoding is None:
+            return info.size <= self.max_file_size
+        if info.gzip_path:
+            return info.gzip_size <= self.max_file_size
+        return info.size <= self.max_compress_size
+
+    def get(self, info:StaticFileInfo, encoding=None):
+        """
+        获取文件的响应头和内容，没有缓存或文件已经修改返回None
+        :param encoding: 压缩方式，None表示不压缩
+        """
+        key = (info.path, encoding)
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if item[0] == self._version(info):
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return item[1], item[2]
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def load(self, info:StaticFileInfo, encoding=None, level=6):
+        """
+        读取文件放入缓存，返回文件的响应头和内容，读取到的大小和文件信息不一致（文件正在修改）返回None
+        :param level: 没有.gz文件时的压缩等级
+        """
+        path, size = info.path, info.size
+        if encoding and info.gzip_path:
+            path, size = info.gzip_path, info.gzip_size
+        try:
+            with open(path, "rb") as fp:
+                body = fp.read(size + 1)
+        except OSError:
+            return None
+        if len(body) != size:
+            return None
+        if encoding and not info.gzip_path:
+            body = Utils.compress(body, encoding, level)
+        header = FileResponse.serialize_file_header(info.path, info.mime_type, len(body), encoding)
+        key = (info.path, encoding)
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (self._version(info), header, body)
+            self._length += len(header) + len(body)
+            while self._length > self.max_length and self._items:
+                self._remove(next(iter(self._items)))
+        return header, body
+
+    def _remove(self, key):
+        item = self._items.pop(key)
+        self._length -= len(item[1]) + len(item[2])
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._length = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"count": len(self._items), "length": self._length, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0}
+
+
 class StaticFileHandler(RequestHandler):
     # 下载静态文件
     response: FileResponse  # 通过类型重新定义覆盖提示，使得IDE能够正确
@@ -1650,43 +3441,112 @@ class StaticFileHandler(RequestHandler):
         return FileResponse()
 
     def request_info(self, include_body):
-        file_path = self.get_file_path()
-        if not file_path:
-            self.write_error(404, "", "{0} FILE NOT FOUND".format(file_path))
+        info = self.get_file_info()
+        if not info:
+            self.write_error(404, "", "{0} FILE NOT FOUND".format(self.request.path))
             return False
-        # 尝试读取文件的类型
-        mine_type = Utils.get_file_mime_type(file_path)
+        file_path = info.path
+        mine_type = info.mime_type
+        # 可以压缩的文件，响应的内容和请求头Accept-Encoding有关
+        compressible = Application.ins().compress_support and Utils.is_compressible(mine_type)
+        if compressible:
+            self.response.add_vary("Accept-Encoding")
         # 特殊处理head请求，只返回头，不发body数据
         if not include_body:
             self.response.only_header()
-        # 客户端想通过range读取数据
-        request_range = self.request.get_header("Range")
-        if request_range and Application.ins().range_support:
-            self.response.set_file(file_path, mine_type)
-            self.response.enable_range(request_range)
-            return
-        # 如果服务器开启了缓存模式
-        if Application.ins().static_cache:
-            # 检查客户端是否带有缓存请求
-            if_modify_date = self.request.get_header("If-Modified-Since")
-            cache_control = self.request.get_header("Cache-Control")
-            file_modify_date = Utils.file_modify_date(file_path)
-            # 如果客户端明确说不使用缓存，那么不走缓存
-            if cache_control and cache_control.find("no-store") >= 0:
-                self.response.set_file(file_path, mine_type)
-                return
+        app = Application.ins()
+        request_range = self.request.get_header("Range") if app.range_support else None
+        # 客户端支持gzip时发送压缩后的内容，range请求不压缩
+        encoding = None
+        if compressible and not request_range and (info.gzip_path or self.memory_cacheable(info, "gzip")) and \
+                Utils.select_encoding(self.request.get_header("Accept-Encoding"), ("gzip",)):
+            encoding = "gzip"
+        etag = info.gzip_etag if encoding else info.etag
+        # 如果服务器开启了缓存模式，如果客户端明确说不使用缓存，那么不走缓存
+        cache_control = self.request.get_header("Cache-Control")
+        if app.static_cache and not (cache_control and cache_control.find("no-store") >= 0):
             # 服务器建议客户端走缓存
             self.response.set_header("Cache-Control", "max-age=3600")
-            self.response.set_header("Last-Modified", file_modify_date)
-            # 如果客户端确实有带有文件修改时间，那就检查缓存
-            if if_modify_date and if_modify_date == file_modify_date:
+            self.response.set_header("Last-Modified", info.last_modified)
+            self.response.set_header("ETag", etag)
+            # 客户端带有缓存的ETag或者修改时间，文件没有变化返回304
+            if self.not_modified(info, etag):
                 self.response.set_status(304)
                 return
+        # 客户端想通过range读取数据，If-Range不匹配时文件已经修改，发送整个文件
+        if request_range and self.range_match(info, etag):
+            self.response.set_file(file_path, mine_type, info.size)
+            self.response.enable_range(request_range)
+            return
         # 如果HTTP/1.1 那么可以让客户端请求使用range模式
         if self.request.version_number >= (1, 1) and Application.ins().range_support:
             self.response.set_header("Accept-Ranges", "bytes")
+        # 小文件从内存中发送
+        if self.set_memory_file(info, encoding):
+            return
+        if encoding and info.gzip_path:
+            # 发送预先压缩好的.gz文件，文件名还是原文件的
+            self.response.set_header("Content-Encoding", encoding)
+            self.response.set_header("Content-Disposition", "attachment; filename={0}".format(os.path.basename(file_path)))
+            self.response.set_file(info.gzip_path, mine_type, info.gzip_size)
+            return
+        if encoding and "ETag" in self.response.headers:
+            # 没能读取压缩的内容，发送的是原文件
+            self.response.set_header("ETag", info.etag)
         # 设置文件路径
-        self.response.set_file(file_path, mine_type)
+        self.response.set_file(file_path, mine_type, info.size)
+
+    def not_modified(self, info:StaticFileInfo, etag):
+        """
+        检查客户端缓存的文件是否和当前的一致，If-None-Match优先于If-Modified-Since
+        """
+        if_none_match = self.request.get_header("If-None-Match")
+        if if_none_match:
+            return Utils.etag_match(if_none_match, etag)
+        if_modified_since = self.request.get_header("If-Modified-Since")
+        if if_modified_since:
+            since = Utils.parse_http_date(if_modified_since)
+            # HTTP的时间只精确到秒
+            return since is not None and int(info.mtime) <= since
+        return False
+
+    def range_match(self, info:StaticFileInfo, etag):
+        """
+        检查If-Range，客户端已经下载的部分和当前文件一致时才能继续按range下载
+        """
+        if_range = self.request.get_header("If-Range")
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith('W/"'):
+            return Utils.etag_match(if_range, etag, weak=False)
+        since = Utils.parse_http_date(if_range)
+        return since is not None and int(info.mtime) == since
+
+    @staticmethod
+    def memory_cacheable(info:StaticFileInfo, encoding=None):
+        # 文件是否可以从内存缓存发送，开启了限速时不使用内存缓存
+        app = Application.ins()
+        if app.connection_rate_limit or app.rate_limiter:
+            return False
+        return app.static_memory_cache.cacheable(info, encoding)
+
+    def set_memory_file(self, info:StaticFileInfo, encoding=None):
+        """
+        使用内存缓存发送文件，文件太大或者开启了限速时返回False
+        :param encoding: 压缩方式，None表示不压缩
+        """
+        if not self.memory_cacheable(info, encoding):
+            return False
+        app = Application.ins()
+        cache = app.static_memory_cache
+        memory_file = cache.get(info, encoding)
+        if memory_file is None:
+            memory_file = cache.load(info, encoding, app.config.compress_level)
+            if memory_file is None:
+                return False
+        self.response.set_memory_file(*memory_file)
+        return True
 
     def head(self):
         """
@@ -1700,79 +3560,196 @@ class StaticFileHandler(RequestHandler):
         """
         self.request_info(True)
 
+    def get_file_info(self):
+        """
+        获取文件的信息，文件不存在返回None
+        """
+        return Application.ins().static_file_cache.get(self.request.path)
+
     def get_file_path(self):
         """
         获取文件的路径
         """
-        # 对url进行解码，有可能有带空格的文件之类的
-        path = urllib.parse.unquote(self.request.path)
-        if not path.startswith("/static/"):
-            return None
-        # 这里的static_path路径已经是绝对路径了
-        static_path = Application.ins().static_path
-        path = path[len("/static/"):]
-        url_route_path = path.lstrip("/")
-        file_path = os.path.join(static_path, url_route_path)
-        # 这里一定要严格检查资源路径，否则存在服务器被【路径遍历攻击】的风险
-        # 请求人员可以/static/../../../../../etc/passwd 获取全部用户信息
-        abs_file_path = os.path.abspath(file_path)
-        if not abs_file_path.startswith(static_path):
-            return None
-        if not os.path.isfile(file_path) or not os.path.exists(file_path):
-            return None
-        return file_path
+        info = self.get_file_info()
+        return info.path if info else None
+
+
+class _LoopWorker:
+    """ 工作线程，线程内常驻一个事件循环，同一个线程可以同时调度多个会话协程 """
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.loop = asyncio.new_event_loop()
+        self.tasks = set()          # 当前线程内正在执行的协程任务
+        self.pending = 0            # 已投递但是还没有开始执行的任务数
+        self.thread = threading.Thread(target=self.run, name="hibou-worker-{0}".format(index), daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+            # 循环停止后，取消还没有结束的任务，让它们有机会清理资源
+            tasks = [task for task in self.tasks if not task.done()]
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        finally:
+            self.loop.close()
+
+    @property
+    def load(self):
+        return len(self.tasks) + self.pending
+
+    def submit(self, fn, params):
+        with self.pool._lock:
+            self.pending += 1
+        self.loop.call_soon_threadsafe(self._spawn, fn, params, time.monotonic())
+
+    def _spawn(self, fn, params, put_time):
+        with self.pool._lock:
+            self.pending -= 1
+        self.pool._record_wait(time.monotonic() - put_time)
+        try:
+            task = self.loop.create_task(fn(*params))
+        except Exception as e:
+            logging.exception("run task error:%s", e)
+            return
+        self.tasks.add(task)
+        task.add_done_callback(self._on_done)
+
+    def _on_done(self, task):
+        self.tasks.discard(task)
+        if task.cancelled():
+            return
+        e = task.exception()
+        if e is not None:
+            logging.error("run task error:%s", e, exc_info=e)
+
+    def stop(self):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
 
 
 class ThreadLoopPool:
+    """
+    协程线程池，每个工作线程都常驻一个事件循环。
+    提交的协程函数会分配到当前负载最小的线程上执行，同一线程内的多个会话可以在await处交替执行。
+    """
+
     def __init__(self, max_work=2):
         self.max_work = max_work
-        self.active_thread = []
-        self.task_queue = queue.Queue()
+        self.active_thread = []     # type: list[_LoopWorker]
         self._shutdown = False
-
-    def thread_void(self):
-        loop = asyncio.new_event_loop()
-        while not self._shutdown:
-            try:
-                if self.task_queue.empty():
-                    time.sleep(0.001)
-                    continue
-                task = self.task_queue.get(False, 1)
-                if not task:
-                    continue
-                fn, params = task[0], task[1]
-                fn(loop, *params)
-            except Exception as e:
-                logging.exception("run task error:%s", e)
+        self._lock = threading.Lock()
+        # 统计信息：已处理任务数、累计等待时间、最大等待时间
+        self._task_count = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _record_wait(self, wait_time):
+        with self._lock:
+            self._task_count += 1
+            self._total_wait += wait_time
+            if wait_time > self._max_wait:
+                self._max_wait = wait_time
+
+    def _select_worker(self):
+        with self._lock:
+            if self.active_thread:
+                worker = min(self.active_thread, key=lambda w: w.load)
+                # 已有的线程都在忙，并且还没有达到上限，那么就新开一个线程
+                if worker.load == 0 or len(self.active_thread) >= self.max_work:
+                    return worker
+            worker = _LoopWorker(self, len(self.active_thread))
+            worker.start()
+            self.active_thread.append(worker)
+            return worker
 
     def submit(self, fn, *params):
-        size = len(self.active_thread)
-        if size < self.max_work:
-            p = threading.Thread(target=self.thread_void, args=())
-            p.start()
-            self.active_thread.append(p)
-        task = [fn, params]
-        self.task_queue.put(task)
-
-    def shutdown(self):
+        """
+        投递一个协程函数到工作线程执行
+        :param fn: 协程函数 async def
+        :param params: 协程函数的参数
+        """
+        if self._shutdown:
+            raise RuntimeError("ThreadLoopPool is shutdown")
+        self._select_worker().submit(fn, params)
+
+    def stats(self):
+        """
+        线程池的运行状态
+        :return: 包含排队任务数、执行中任务数、已处理任务数、平均和最大等待时间（秒）的字典
+        """
+        with self._lock:
+            count = self._task_count
+            return {
+                "threads": len(self.active_thread),
+                "queue_size": sum(w.pending for w in self.active_thread),
+                "running": sum(len(w.tasks) for w in self.active_thread),
+                "task_count": count,
+                "avg_wait": self._total_wait / count if count else 0.0,
+                "max_wait": self._max_wait,
+            }
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        关闭线程池，停止所有工作线程的事件循环，未完成的任务会被取消
+        :param wait: 是否等待工作线程退出
+        :param timeout: 等待每个线程退出的超时时间
+        """
+        if self._shutdown:
+            return
         self._shutdown = True
+        with self._lock:
+            workers = list(self.active_thread)
+        for worker in workers:
+            worker.stop()
+        if not wait:
+            return
+        for worker in workers:
+            if worker.thread is not threading.current_thread():
+                worker.thread.join(timeout)
 
 
 class HttpServer:
-    def __init__(self, host='127.0.0.1', port=8080):
+    def __init__(self, host='127.0.0.1', port=8080, sock=None):
         self.host = host
         self.port = port
         self.selector = selectors.DefaultSelector()
         self.server_socket = None
+        self.listen_socket = sock   # 外部已经创建好的监听socket，多进程模式下由主进程创建
         self.routes = {}
         self.session_map = {}
         self.thread_pool = ThreadLoopPool(Application.ins().max_thread)
 
+    @staticmethod
+    def create_listen_socket(host, port, reuse_port=False):
+        """
+        创建监听的socket
+        :param reuse_port: 是否开启SO_REUSEPORT，多个进程可以绑定同一个端口，由内核分配连接
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(Application.ins().backlog)
+        # 多个进程共享监听socket时，同一个连接只有一个进程能accept成功，其他进程不能阻塞在accept上
+        sock.setblocking(False)
+        return sock
+
+    def get_listen_socket(self):
+        if self.listen_socket is not None:
+            return self.listen_socket
+        return self.create_listen_socket(self.host, self.port)
+
     def create_server_socket(self):
         # 启动HTTP服务器
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(Application.ins().backlog)
+        self.server_socket = self.get_listen_socket()
         self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept)
 
         logging.debug(f"Server started at {self.host}:{self.port}")
@@ -1799,8 +3776,12 @@ class HttpServer:
         try:
             client_socket, addr = server_socket.accept()
             logging.debug(f"Connection from {addr}")
+            # 响应已经在Session中合并发送，关闭Nagle算法，避免响应头和文件内容分两次发送时等待客户端的延迟确认
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             client_socket.setblocking(False)
             self.selector.register(client_socket, selectors.EVENT_READ, self.read)
+        except BlockingIOError:
+            pass    # 连接已经被其他进程接收
         except Exception as e:
             logging.exception(f"Error accepting connection: {e}")
 
@@ -1811,19 +3792,20 @@ class HttpServer:
         if session is None:
             session = Session(client_socket)
             self.session_map[client_socket] = session
-        # loop = asyncio.get_event_loop()
-        # loop.create_task(self.handle_session(session))
-        self.thread_pool.submit(self.handle_task, session)
-
-    def handle_task(self, loop:asyncio.AbstractEventLoop, session:Session):
-        try:
-            loop.run_until_complete(self.handle_session(session))
-        except Exception as e:
-            logging.exception("handle task error:%s", e)
+        # 会话交给工作线程常驻的事件循环处理，同一个线程可以交替处理多个会话
+        self.thread_pool.submit(self.handle_session, session)
 
     async def handle_session(self, session:Session):
-        handler = SessionHandler(session)
-        await handler.do_handler()
+        while True:
+            handler = SessionHandler(session)
+            try:
+                await handler.do_handler()
+            except Exception as e:
+                logging.exception("handle session error:%s", e)
+                handler.close_connection = True
+            # 客户端使用pipelining时，后面的请求已经在读缓冲区中，selector不会再通知可读，需要直接处理
+            if handler.close_connection or not session.has_buffered_data():
+                break
         if handler.close_connection:
             session.close()
             logging.debug(f"Session {session.session_id} closed")
@@ -1834,14 +3816,13 @@ class HttpServer:
 
 
 class HttpSSLServer(HttpServer):
-    def __init__(self, host, port, cert_file, keyfile):
-        super().__init__(host, port)
+    def __init__(self, host, port, cert_file, keyfile, sock=None):
+        super().__init__(host, port, sock)
         self.cert_file = cert_file
         self.keyfile = keyfile
         self.context = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
 
     def create_server_socket(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.context.load_cert_chain(self.cert_file, self.keyfile)
         # 这里在正式环境中应该不进行设置
         if Application.ins().is_debug_https:
@@ -1850,9 +3831,7 @@ class HttpSSLServer(HttpServer):
         else:
             self.context.verify_mode = ssl.CERT_REQUIRED
         # do_handshake_on_connect = False 禁止连接时立即握手，采用手动握手
-        self.server_socket = self.context.wrap_socket(self.server_socket, server_side=True, do_handshake_on_connect=False)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(Application.ins().backlog)
+        self.server_socket = self.context.wrap_socket(self.get_listen_socket(), server_side=True, do_handshake_on_connect=False)
         self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept)
         logging.info(f"SSL Server started at {self.host}:{self.port}")
 
@@ -1878,13 +3857,226 @@ class HttpSSLServer(HttpServer):
         try:
             client_socket, addr = server_socket.accept()
             logging.debug(f"Connection from {addr}")
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.do_handshake(client_socket)
             client_socket.setblocking(False)
             self.selector.register(client_socket, selectors.EVENT_READ, self.read)
+        except BlockingIOError:
+            pass    # 连接已经被其他进程接收
         except Exception as e:
             logging.exception(f"Error accepting connection: {e}")
 
 
+class StreamHttpServer:
+    """
+    基于asyncio.start_server的HTTP服务，连接的读写都使用asyncio的流对象。
+    不需要selector和线程池之间来回切换socket的阻塞模式，适合大量keep-alive的长连接。
+    注意：所有会话都在同一个事件循环内执行，处理方法中不要有长时间的阻塞操作。
+    """
+
+    def __init__(self, host='127.0.0.1', port=8080, sock=None):
+        self.host = host
+        self.port = port
+        self.listen_socket = sock   # 外部已经创建好的监听socket，多进程模式下由主进程创建
+        self.server = None      # type: asyncio.AbstractServer or None
+
+    def create_ssl_context(self):
+        # 普通HTTP不需要ssl
+        return None
+
+    def start(self):
+        try:
+            asyncio.run(self.server_loop())
+        except KeyboardInterrupt:
+            logging.debug("Server shutting down...")
+
+    async def server_loop(self):
+        sock = self.listen_socket
+        if sock is None:
+            sock = HttpServer.create_listen_socket(self.host, self.port)
+        self.server = await asyncio.start_server(self.handle_connection, sock=sock,
+                                                 backlog=Application.ins().backlog,
+                                                 ssl=self.create_ssl_context())
+        logging.debug(f"Stream server started at {self.host}:{self.port}")
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_connection(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        session = StreamSession(reader, writer)
+        try:
+            # 同一个连接上的请求依次处理，直到需要关闭连接
+            while not session.closed:
+                handler = SessionHandler(session)
+                await handler.do_handler()
+                if handler.close_connection:
+                    break
+        except Exception as e:
+            logging.exception("handle connection error:%s", e)
+        finally:
+            session.close()
+            logging.debug(f"Session {session.session_id} closed")
+
+
+class StreamHttpSSLServer(StreamHttpServer):
+    def __init__(self, host, port, cert_file, keyfile, sock=None):
+        super().__init__(host, port, sock)
+        self.cert_file = cert_file
+        self.keyfile = keyfile
+
+    def create_ssl_context(self):
+        context = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(self.cert_file, self.keyfile)
+        # 这里在正式环境中应该不进行设置
+        if Application.ins().is_debug_https:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        else:
+            context.verify_mode = ssl.CERT_REQUIRED
+        return context
+
+
+class HandlerDispatch:
+    """
+    注册路由时预先生成的处理类的方法表，处理请求时只需要一次字典查找
+    只有处理类自己实现（覆盖了BaseRequestHandler默认实现）的方法才是允许的方法，其他的返回405
+    """
+    __slots__ = ("handler_cls", "methods", "allow", "upload_sinks")
+    HTTP_METHODS = ("get", "head", "post", "put", "delete", "patch", "options")
+
+    def __init__(self, handler_cls, upload_sinks:dict=None):
+        self.handler_cls = handler_cls
+        # 上传文件的字段名 -> UploadSink，路由中声明的覆盖处理类的upload_sinks，函数包装为CallableSink
+        self.upload_sinks = {}
+        for sinks in (handler_cls.upload_sinks, upload_sinks):
+            for name, sink in (sinks or {}).items():
+                self.upload_sinks[name] = sink if isinstance(sink, UploadSink) else CallableSink(sink)
+        self.methods = {}
+        for name in self.HTTP_METHODS:
+            method = getattr(handler_cls, name, None)
+            if not callable(method) or method is getattr(BaseRequestHandler, name, None):
+                continue
+            self.methods[name] = method
+        self.allow = ", ".join(name.upper() for name in self.methods)   # 405时返回的Allow头
+
+
+class _RouteNode:
+    # 路由树的节点，每个节点对应路径中的一段
+    __slots__ = ("children", "params", "wildcard", "handler")
+
+    def __init__(self):
+        self.children = {}      # 固定的段 -> _RouteNode
+        self.params = []        # 参数段 [(参数名, 类型, 转换函数, _RouteNode)]
+        self.wildcard = None    # 匹配剩余所有路径的参数 (参数名, handler)
+        self.handler = None
+
+
+class Router:
+    """
+    路由表，路径按"/"分段组成前缀树，匹配的耗时只和请求路径的段数有关，和注册的路由数量无关
+    支持的路由格式：
+        /user/list              固定路径，直接字典查找
+        /user/{name}            参数，匹配一段
+        /user/{id:int}          整数参数，匹配一段数字并转换成int
+        /files/{path:*}         匹配剩余的所有路径（可以为空），只能是最后一段
+    同一位置上固定的段优先于参数，整数参数优先于普通参数
+    """
+    CONVERTERS = {
+        "str": lambda value: value,
+        "int": lambda value: int(value) if value.isascii() and value.isdigit() else None,
+    }
+
+    def __init__(self):
+        self.static_routes = {}
+        self.root = _RouteNode()
+
+    def add(self, path:str, handler):
+        if "{" not in path:
+            self.static_routes[path] = handler
+            return
+        if not path.startswith("/"):
+            raise ValueError("route path must start with '/': %s" % path)
+        node = self.root
+        segments = path.split("/")[1:]
+        for index, segment in enumerate(segments):
+            if not (segment.startswith("{") and segment.endswith("}")):
+                if "{" in segment or "}" in segment:
+                    raise ValueError("invalid route segment:%s in %s" % (segment, path))
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = _RouteNode()
+                node = child
+                continue
+            name, _, kind = segment[1:-1].partition(":")
+            kind = kind or "str"
+            if kind == "*":
+                if index != len(segments) - 1:
+                    raise ValueError("{%s:*} must be the last segment of route:%s" % (name, path))
+                node.wildcard = (name, handler)
+                return
+            converter = self.CONVERTERS.get(kind)
+            if converter is None:
+                raise ValueError("unknown route param type:%s in %s" % (kind, path))
+            node = self._param_node(node, name, kind, converter)
+        node.handler = handler
+
+    @staticmethod
+    def _param_node(node:_RouteNode, name, kind, converter):
+        for param_name, param_kind, _, child in node.params:
+            if param_kind == kind:
+                if param_name != name:
+                    raise ValueError("route param {%s:%s} conflicts with {%s:%s}" % (name, kind, param_name, kind))
+                return child
+        child = _RouteNode()
+        item = (name, kind, converter, child)
+        if kind == "str":
+            node.params.append(item)
+        else:
+            # 有类型的参数先匹配
+            index = 0
+            while index < len(node.params) and node.params[index][1] != "str":
+                index += 1
+            node.params.insert(index, item)
+        return child
+
+    def match(self, path:str):
+        """
+        匹配路由
+        :return: (handler, 路径参数)，没有匹配到返回(None, None)
+        """
+        handler = self.static_routes.get(path)
+        if handler is not None:
+            return handler, {}
+        params = {}
+        handler = self._match(self.root, path.split("/")[1:], 0, params)
+        if handler is None:
+            return None, None
+        return handler, params
+
+    def _match(self, node:_RouteNode, segments, index, params):
+        if index == len(segments):
+            return node.handler
+        segment = segments[index]
+        child = node.children.get(segment)
+        if child is not None:
+            handler = self._match(child, segments, index + 1, params)
+            if handler is not None:
+                return handler
+        if segment:
+            for name, _, converter, child in node.params:
+                value = converter(segment)
+                if value is None:
+                    continue
+                handler = self._match(child, segments, index + 1, params)
+                if handler is not None:
+                    params[name] = value
+                    return handler
+        if node.wildcard is not None:
+            name, handler = node.wildcard
+            params[name] = "/".join(segments[index:])
+            return handler
+        return None
+
+
 class Application:
     # 单例对象
     _instance = None
@@ -1898,7 +4090,13 @@ class Application:
     def __init__(self):
         super().__init__()
         self.config = None  # type: HttpConfig or None
-        self.routes = {}
+        self.router = Router()
+        self._template_loader = None    # type: TemplateLoader or None
+        self._static_file_cache = None  # type: StaticFileCache or None
+        self.fragment_cache = FragmentCache()   # 模板片段缓存
+        self.static_memory_cache = StaticMemoryCache()  # 小的静态文件的内存缓存
+        self.router.add("/static/{path:*}", HandlerDispatch(StaticFileHandler))
+        self.rate_limiter = None    # 全局的限速器 type: RateLimiter or None
         self.system_start_handlers = {}
         self.system_stop_handlers = {}
 
@@ -1914,6 +4112,22 @@ class Application:
     def range_support(self):
         return self.config.support_range
 
+    @property
+    def max_range_count(self):
+        return self.config.max_range_count
+
+    @property
+    def compress_support(self):
+        return self.config.support_compress
+
+    @property
+    def sendfile_support(self):
+        return self.config.support_sendfile
+
+    @property
+    def connection_rate_limit(self):
+        return self.config.connection_rate_limit
+
     @property
     def static_path(self):
         return self.config.static_path
@@ -1922,10 +4136,36 @@ class Application:
     def template_path(self):
         return self.config.template_path
 
+    @property
+    def template_loader(self):
+        loader = self._template_loader
+        if loader is None or loader.root != self.config.template_path:
+            loader = TemplateLoader(self.config.template_path, self.config.template_cache_size,
+                                    self.config.template_cache_dir)
+            self._template_loader = loader
+        return loader
+
+    @property
+    def static_file_cache(self):
+        cache = self._static_file_cache
+        if cache is None or cache.root != self.config.static_path:
+            cache = StaticFileCache(self.config.static_path, self.config.static_stat_ttl,
+                                    self.config.static_stat_cache_size)
+            self._static_file_cache = cache
+        return cache
+
     @property
     def max_buff_size(self):
         return self.config.max_buff_size
 
+    @property
+    def max_header_size(self):
+        return self.config.max_header_size
+
+    @property
+    def max_header_count(self):
+        return self.config.max_header_count
+
     @property
     def backlog(self):
         return self.config.backlog
@@ -1946,18 +4186,27 @@ class Application:
     def ssl_cert(self):
         return self.config.ssl_cert
 
+    @property
+    def stream_server(self):
+        return self.config.stream_server
+
     def get_runtime_argument(self, name):
         return self.config.runtime_global_params.get(name, None)
 
-    def add_route(self, path, handler_cls):
+    def add_route(self, path, handler_cls, upload_sinks:dict=None):
+        """
+        添加路由，路径中可以使用参数，例如：/user/{id:int}/files/{path:*}，格式见Router
+        :param upload_sinks: 上传文件的字段名 -> UploadSink或者函数，覆盖处理类的upload_sinks
+        """
         if not issubclass(handler_cls, BaseRequestHandler):
             raise ValueError("handler_cls must be a subclass of BaseRequestHandler")
-        self.routes[path] = handler_cls
+        self.router.add(path, HandlerDispatch(handler_cls, upload_sinks))
 
     def match_route(self, path):
-        if path.startswith("/static/"):
-            return StaticFileHandler
-        return self.routes.get(path, None)
+        """
+        :return: (HandlerDispatch, 路径参数)，没有匹配到返回(None, None)
+        """
+        return self.router.match(path)
 
     def load_all_scripts(self):
         # 加载所有的脚本
@@ -1982,22 +4231,116 @@ class Application:
 
     def start_server(self, config:HttpConfig, host="127.0.0.1", port=8080):
         self.config = config
+        self.fragment_cache.max_count, self.fragment_cache.max_length = config.fragment_cache_size
+        self.static_memory_cache.max_length, self.static_memory_cache.max_file_size = config.static_memory_cache_size
+        self.static_memory_cache.max_compress_size = config.compress_static_max_size
         if self.config.script_path and os.path.exists(self.config.script_path):
             sys.path.append(self.config.script_path)
             self.load_all_scripts()
+        if config.template_precompile and config.template_path:
+            start_time = time.monotonic()
+            count = self.template_loader.precompile()
+            logging.info("precompile %s templates in %.3fs", count, time.monotonic() - start_time)
+        if config.worker_process > 1:
+            if hasattr(os, "fork"):
+                self.run_prefork(host, port)
+                return
+            logging.warning("os.fork is not supported, run in single process")
+        self.run_server(host, port)
+
+    def create_server(self, host, port, sock=None):
+        config = self.config
+        if config.stream_server:
+            if config.is_https:
+                key_file, cert_file = config.ssl_cert
+                return StreamHttpSSLServer(host, port, cert_file, key_file, sock)
+            return StreamHttpServer(host, port, sock)
+        elif config.is_https:
+            key_file, cert_file = config.ssl_cert
+            return HttpSSLServer(host, port, cert_file, key_file, sock)
+        return HttpServer(host, port, sock)
+
+    def run_server(self, host, port, sock=None, worker_count=1):
+        # 在当前进程中启动服务，多进程模式下每个工作进程都会调用
+        if self.config.total_rate_limit:
+            # 限速器不能在进程之间共享，多进程时总限速平均分给每个工作进程
+            self.rate_limiter = RateLimiter(max(1, self.config.total_rate_limit // worker_count))
         logging.debug("do system start call")
         for name, handle in self.system_start_handlers.items():
             handle()
-        if config.is_https:
-            key_file, cert_file = config.ssl_cert
-            server = HttpSSLServer(host, port, cert_file, key_file)
-        else:
-            server = HttpServer(host, port)
+        server = self.create_server(host, port, sock)
         server.start()
         logging.debug("do system stop call")
         for name, handle in self.system_stop_handlers.items():
             handle()
 
+    @staticmethod
+    def _raise_interrupt(signum, frame):
+        # 收到SIGTERM时按照Ctrl+C的流程退出，这样能执行on_stop的回调
+        raise KeyboardInterrupt()
+
+    def _fork_worker(self, index, host, port, sock):
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        # 工作进程
+        code = 0
+        try:
+            if sock is None:
+                sock = HttpServer.create_listen_socket(host, port, True)
+            logging.debug("worker %s pid:%s started", index, os.getpid())
+            self.run_server(host, port, sock, self.config.worker_process)
+        except KeyboardInterrupt:
+            pass
+        except BaseException as e:
+            logging.exception("worker %s error:%s", index, e)
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def run_prefork(self, host, port):
+        """
+        多进程模式：主进程fork出多个工作进程，每个进程各自运行HttpServer，
+        主进程只负责监控，工作进程退出后重新拉起，收到退出信号时通知所有工作进程退出
+        """
+        config = self.config
+        sock = None
+        if not config.reuse_port or not hasattr(socket, "SO_REUSEPORT"):
+            # 不使用SO_REUSEPORT时，由主进程创建监听socket，工作进程共享
+            sock = HttpServer.create_listen_socket(host, port)
+        signal.signal(signal.SIGTERM, self._raise_interrupt)
+        workers = {}    # pid -> (index, start_time)
+        for index in range(config.worker_process):
+            workers[self._fork_worker(index, host, port, sock)] = (index, time.monotonic())
+        try:
+            while workers:
+                pid, status = os.wait()
+                if pid not in workers:
+                    continue
+                index, start_time = workers.pop(pid)
+                logging.error("worker %s pid:%s exit with status:%s, restart it", index, pid, status)
+                # 启动后很快就退出的，稍等一下再拉起，避免频繁fork
+                if time.monotonic() - start_time < 1:
+                    time.sleep(1)
+                workers[self._fork_worker(index, host, port, sock)] = (index, time.monotonic())
+        except KeyboardInterrupt:
+            logging.debug("Server shutting down...")
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            for pid in workers:
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+            if sock is not None:
+                sock.close()
+
     def add_system_start_handle(self, handle):
         if not callable(handle):
             raise TypeError("add_system_start_handle: {0} it not callable".format(handle))
@@ -2020,12 +4363,17 @@ class Application:
             if filename.startswith(root):
                 importlib.reload(m)
         self.load_all_scripts()
+        if self._template_loader is not None:
+            self._template_loader.reset()
+        if self._static_file_cache is not None:
+            self._static_file_cache.clear()
+        self.static_memory_cache.clear()
 
 
-def route(path):
+def route(path, upload_sinks:dict=None):
     # 装饰器 绑定路由
     def decorator(cls):
-        Application.ins().add_route(path, cls)
+        Application.ins().add_route(path, cls, upload_sinks)
         return cls
     return decorator
 
@@ -2042,6 +4390,57 @@ def reload():
 def get_argument(name):
     return Application.ins().get_runtime_argument(name)
 
+
+async def sleep(seconds):
+    # 在async的处理方法中等待，不会阻塞工作线程
+    await asyncio.sleep(seconds)
+
+
+async def run_process(*args, input=None, timeout=None):
+    """
+    在async的处理方法中执行子进程并等待结束
+    :param args: 命令和参数，例如 run_process("ls", "-l")
+    :param input: 写入子进程标准输入的数据
+    :param timeout: 超时秒数，超时后结束子进程并抛出asyncio.TimeoutError
+    :return: (returncode, stdout, stderr)
+    """
+    process = await asyncio.create_subprocess_exec(*args,
+                                                   stdin=asyncio.subprocess.PIPE if input is not None else None,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(input), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, stdout, stderr
+
+
+async def call_socket(address, data:bytes, timeout=None):
+    """
+    在async的处理方法中请求本地的服务：发送数据后读取返回的数据直到对方关闭连接
+    :param address: (host, port)，或者unix socket的路径
+    :param data: 发送的数据
+    :param timeout: 超时秒数，超时抛出asyncio.TimeoutError
+    :return: 返回的数据
+    """
+    async def _call():
+        if isinstance(address, str):
+            reader, writer = await asyncio.open_unix_connection(address)
+        else:
+            reader, writer = await asyncio.open_connection(*address)
+        try:
+            writer.write(data)
+            await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+            return await reader.read()
+        finally:
+            writer.close()
+    return await asyncio.wait_for(_call(), timeout)
+
+
 def on_start():
     # 程序启动时的回调注册
     def decorator(method):
@@ -0,0 +1,46 @@
+# -*- coding:utf-8 -*-
+
+import sys
+import os
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hibou
+
+# 模板渲染的性能测试
+# 分别测试小的片段模板和几千行的大表格页面，输出每次渲染的耗时
+
+SMALL = '<span class="{{ cls }}">{{ name }}</span>'
+
+TABLE = """<html>
+<head><title>{{ title }}</title></head>
+<body>
+<h1>{{ title }}</h1>
+<table>
+    <tr><th>ID</th><th>名称</th><th>价格</th><th>标签</th></tr>
+    {% for row in rows %}
+    <tr class="{{ 'odd' if row['id'] % 2 else 'even' }}">
+        <td>{{ row['id'] }}</td>
+        <td><a href="/item/{{ row['id'] }}">{{ row['name'] }}</a></td>
+        <td>{{ '%.2f' % row['price'] }}</td>
+        <td>{% for tag in row['tags'] %}<i>{{ tag }}</i>{% end %}</td>
+    </tr>
+    {% end %}
+</table>
+<p>共{{ len(rows) }}条</p>
+</body>
+</html>
+"""
+
+
+def bench(title, template, number, /, **kwargs):
+    template.generate(**kwargs)
+    cost = min(timeit.repeat(lambda: template.generate(**kwargs), number=number, repeat=5)) / number
+    print("{0}: {1:.1f} us".format(title, cost * 1000000))
+
+
+if __name__ == "__main__":
+    rows = [{"id": i, "name": "商品<%d> & 'x'" % i, "price": i * 1.5, "tags": ["a", "b", "c"]} for i in range(2000)]
+    bench("small", hibou.Template(SMALL), 100000, cls="item", name="a<b")
+    bench("table 2000 rows", hibou.Template(TABLE), 20, title="列表", rows=rows)
@@ -0,0 +1,140 @@
+# -*- coding:utf-8 -*-
+
+import sys
+import os
+import gzip
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hibou
+
+# 测试响应的压缩和ETag（Response.prepare）
+
+BODY = ("<p>hello hibou</p>\n" * 200).encode("utf-8")
+
+
+def setup_config(compress=True):
+    config = hibou.HttpConfig()
+    if compress:
+        config.using_compress()
+    hibou.Application.ins().config = config
+
+
+def make_request(**headers):
+    request = hibou.Request()
+    for name, value in headers.items():
+        request.headers.add_raw(name.lower().replace("_", "-"), value.encode("latin-1"))
+    return request
+
+
+def make_response(body=BODY, **headers):
+    response = hibou.Response()
+    response.body.write(body)
+    for name, value in headers.items():
+        response.set_header(name, value)
+    return response
+
+
+def test_compress_disabled_by_default():
+    setup_config(compress=False)
+    response = make_response()
+    response.prepare(make_request(Accept_Encoding="gzip"))
+    assert "Content-Encoding" not in response.headers
+    assert "Vary" not in response.headers
+    assert response.body.getvalue() == BODY
+
+
+def test_compress():
+    setup_config()
+    response = make_response()
+    response.prepare(make_request(Accept_Encoding="gzip, deflate"))
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(response.body.getvalue()) == BODY
+
+
+def test_not_compress():
+    setup_config()
+    # 客户端不支持
+    response = make_response()
+    response.prepare(make_request())
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"
+    # 太小的内容
+    response = make_response(b"x" * 100)
+    response.prepare(make_request(Accept_Encoding="gzip"))
+    assert "Content-Encoding" not in response.headers
+    # 不是文本
+    response = make_response(**{"Content-Type": "image/png"})
+    response.prepare(make_request(Accept_Encoding="gzip"))
+    assert "Content-Encoding" not in response.headers
+    assert "Vary" not in response.headers
+
+
+def test_not_compress_with_length():
+    # 处理方法自己设置了Content-Length或Content-Range的不压缩
+    setup_config()
+    for name, value in (("Content-Length", len(BODY)), ("Content-Range", "bytes 0-%d/9999" % (len(BODY) - 1))):
+        response = make_response(**{name: value})
+        response.prepare(make_request(Accept_Encoding="gzip"))
+        assert "Content-Encoding" not in response.headers, name
+        assert "Vary" not in response.headers, name
+        assert response.body.getvalue() == BODY, name
+
+
+def test_etag():
+    setup_config(compress=False)
+    response = make_response()
+    response.enable_etag()
+    response.prepare(make_request())
+    etag = response.headers["ETag"]
+    assert etag.startswith('"') and etag.endswith('"')
+
+    response = make_response()
+    response.enable_etag()
+    response.prepare(make_request(If_None_Match=etag))
+    assert response.status_code == 304
+    assert response.body.getvalue() == b""
+
+    response = make_response(BODY + b"changed")
+    response.enable_etag()
+    response.prepare(make_request(If_None_Match=etag))
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+    response = make_response()
+    response.enable_etag("v1")
+    response.prepare(make_request(If_None_Match='W/"v1"'))
+    assert response.status_code == 304
+    assert response.headers["ETag"] == '"v1"'
+
+
+def test_etag_with_compress():
+    setup_config()
+    response = make_response()
+    response.enable_etag("v1")
+    response.prepare(make_request(Accept_Encoding="gzip"))
+    # 压缩后的内容使用不同的ETag
+    assert response.headers["ETag"] == '"v1-gzip"'
+
+    for if_none_match in ('"v1-gzip"', '"v1"'):
+        response = make_response()
+        response.enable_etag("v1")
+        response.prepare(make_request(Accept_Encoding="gzip", If_None_Match=if_none_match))
+        assert response.status_code == 304
+        assert response.body.getvalue() == b""
+        assert "Content-Encoding" not in response.headers
+
+    # 客户端不支持压缩时，压缩版本的ETag不匹配
+    response = make_response()
+    response.enable_etag("v1")
+    response.prepare(make_request(If_None_Match='"v1-gzip"'))
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"v1"'
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+    print("ok")
@@ -0,0 +1,134 @@
+# -*- coding:utf-8 -*-
+
+import sys
+import os
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hibou
+
+# 测试multipart/form-data的流式解析MultipartParser和上传文件的UploadSink
+
+BOUNDARY = b"----hibouBoundary7MA4YWxk"
+
+
+def make_body(parts):
+    # parts: [(name, filename, data)]，filename为None的是普通字段
+    out = [b"preamble\r\n"]
+    for name, filename, data in parts:
+        out.append(b"--" + BOUNDARY + b'\r\nContent-Disposition: form-data; name="' + name + b'"')
+        if filename is not None:
+            out.append(b'; filename="' + filename + b'"\r\nContent-Type: application/octet-stream')
+        out.append(b"\r\n\r\n" + data + b"\r\n")
+    out.append(b"--" + BOUNDARY + b"--\r\n")
+    return b"".join(out)
+
+
+def parse(body, split=None, sinks=None):
+    parser = hibou.MultipartParser(BOUNDARY, sinks)
+    try:
+        step = split or len(body)
+        for index in range(0, len(body), step):
+            parser.write(body[index:index + step])
+        return parser.finish()
+    except BaseException:
+        parser.close()
+        raise
+
+
+def read_fields(fields):
+    result = []
+    for field in fields:
+        if isinstance(field, hibou.FileField):
+            result.append((field.name, field.filename, field.read(field.size)))
+            field.close()
+        else:
+            result.append((field.name, field.value))
+    return result
+
+
+# 文件内容中有类似分隔符的数据
+TRICKY = (b"\r\n--" + BOUNDARY[:-3]) * 20 + b"\r\n-" + os.urandom(1000) + b"--" + BOUNDARY[:5]
+PARTS = [(b"k", None, b"val\r\nline2"), (b"e", None, b""), (b"f", b"a.txt", TRICKY), (b"z", b"empty.txt", b"")]
+EXPECTED = [("k", "val\r\nline2"), ("e", ""), ("f", "a.txt", TRICKY), ("z", "empty.txt", b"")]
+
+
+def test_parse():
+    assert read_fields(parse(make_body(PARTS))) == EXPECTED
+
+
+def test_split_boundaries():
+    # 分隔符、部分的头被拆到多次写入中
+    body = make_body(PARTS)
+    for split in (1, 2, 3, 7, len(BOUNDARY), len(BOUNDARY) + 5, 1000):
+        assert read_fields(parse(body, split)) == EXPECTED, split
+
+
+def test_large_file_spills_to_disk():
+    data = os.urandom(hibou.UploadSink.MEMORY_SIZE + 100)
+    fields = parse(make_body([(b"f", b"big.bin", data)]), 64 * 1024)
+    assert fields[0].size == len(data)
+    assert read_fields(fields) == [("f", "big.bin", data)]
+
+
+def test_truncated_body():
+    body = make_body(PARTS)
+    for end in (len(body) - 3, len(body) // 2, 5):
+        try:
+            parse(body[:end])
+        except hibou.RequestParseException as e:
+            assert e.code == 400
+        else:
+            raise AssertionError("truncated body should be rejected")
+
+
+def test_missing_name():
+    body = b"--" + BOUNDARY + b"\r\nContent-Disposition: form-data\r\n\r\nx\r\n--" + BOUNDARY + b"--\r\n"
+    try:
+        parse(body)
+    except hibou.RequestParseException as e:
+        assert e.code == 400
+    else:
+        raise AssertionError("part without name should be rejected")
+
+
+def test_max_size():
+    sinks = {"f": hibou.UploadSink(max_size=100)}
+    assert read_fields(parse(make_body([(b"f", b"a.txt", b"x" * 100)]), sinks=sinks)) == [("f", "a.txt", b"x" * 100)]
+    try:
+        parse(make_body([(b"f", b"a.txt", b"x" * 101)]), 10, sinks=sinks)
+    except hibou.RequestParseException as e:
+        assert e.code == 413
+    else:
+        raise AssertionError("file over max_size should return 413")
+
+
+def test_directory_sink():
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "a.js"), "wb") as fp:
+            fp.write(b"orig")
+        sinks = {"f": hibou.DirectorySink(directory)}
+        fields = parse(make_body([(b"f", b"../../a.js", b"new"), (b"f", b"a.js", b"new2")]), sinks=sinks)
+        # 去掉路径，已经存在的文件不覆盖
+        assert [field.path for field in fields] == [os.path.join(directory, "a-1.js"), os.path.join(directory, "a-2.js")]
+        assert read_fields(fields) == [("f", "../../a.js", b"new"), ("f", "a.js", b"new2")]
+        with open(os.path.join(directory, "a.js"), "rb") as fp:
+            assert fp.read() == b"orig"
+
+        # 其他字段超过大小时，已经接收完成的文件也不保留
+        sinks["g"] = hibou.UploadSink(max_size=10)
+        try:
+            parse(make_body([(b"f", b"b.js", b"new"), (b"g", b"g.txt", b"x" * 11)]), sinks=sinks)
+        except hibou.RequestParseException as e:
+            assert e.code == 413
+        else:
+            raise AssertionError("file over max_size should return 413")
+        assert sorted(os.listdir(directory)) == ["a-1.js", "a-2.js", "a.js"]
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+    print("ok")
@@ -0,0 +1,94 @@
+# -*- coding:utf-8 -*-
+
+import sys
+import os
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hibou
+
+# 测试Range请求头的解析和多个区域的multipart/byteranges响应
+
+
+def test_read_range():
+    assert hibou.Utils.read_range("bytes=0-99", 1000) == [(0, 99)]
+    assert hibou.Utils.read_range("bytes=900-", 1000) == [(900, 999)]
+    assert hibou.Utils.read_range("bytes=-100", 1000) == [(900, 999)]
+    assert hibou.Utils.read_range("bytes=-2000", 1000) == [(0, 999)]
+    assert hibou.Utils.read_range("bytes=990-2000", 1000) == [(990, 999)]
+    # 排序并合并重叠和相邻的区域
+    assert hibou.Utils.read_range("bytes=500-599,0-9,10-19,550-700", 1000) == [(0, 19), (500, 700)]
+    # 无法满足的区域被忽略
+    assert hibou.Utils.read_range("bytes=0-9,2000-3000,-0", 1000) == [(0, 9)]
+    assert not hibou.Utils.read_range("bytes=2000-3000", 1000)
+    assert not hibou.Utils.read_range("bytes=-0", 1000)
+
+
+def test_read_range_invalid():
+    for header in ("items=0-1", "bytes=", "bytes=-", "bytes=5", "bytes=9-5", "bytes=a-b", "bytes=0-1,x"):
+        assert hibou.Utils.read_range(header, 1000) is None, header
+
+
+def make_response(data, header):
+    app = hibou.Application.ins()
+    app.config = hibou.HttpConfig()
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as fp:
+        fp.write(data)
+    try:
+        response = hibou.FileResponse()
+        response.set_file(path, "text/plain")
+        response.enable_range(header)
+        return response
+    finally:
+        os.remove(path)
+
+
+def test_single_range():
+    response = make_response(b"0123456789", "bytes=2-5")
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 2-5/10"
+    assert response.headers["Content-Length"] == 4
+    assert response._range == [2, 5]
+
+
+def test_multi_range():
+    data = bytes(range(256)) * 4
+    response = make_response(data, "bytes=0-9,100-199,-10")
+    assert response.status_code == 206
+    content_type = response.headers["Content-Type"]
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    boundary = content_type.partition("boundary=")[2]
+
+    # 按照发送的方式拼出响应体，长度需要和Content-Length一致
+    body = b""
+    for part_header, start, end in response._range:
+        assert ("Content-Range: bytes %s-%s/%s" % (start, end, len(data))).encode("utf-8") in part_header
+        assert part_header.startswith(("\r\n--" + boundary + "\r\n").encode("utf-8"))
+        body += part_header + data[start:end + 1]
+    body += response._range_end
+    assert response._range_end == ("\r\n--" + boundary + "--\r\n").encode("utf-8")
+    assert response.headers["Content-Length"] == len(body)
+    assert [(start, end) for _, start, end in response._range] == [(0, 9), (100, 199), (1014, 1023)]
+
+
+def test_too_many_ranges():
+    header = "bytes=" + ",".join("%d-%d" % (i * 10, i * 10) for i in range(hibou.HttpConfig().max_range_count + 1))
+    response = make_response(b"x" * 1000, header)
+    assert response.status_code == 200
+    assert "Content-Range" not in response.headers
+
+
+def test_unsatisfiable():
+    response = make_response(b"0123456789", "bytes=100-200")
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */10"
+    assert response._file_path is None
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+    print("ok")
@@ -0,0 +1,91 @@
+# -*- coding:utf-8 -*-
+
+import sys
+import os
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hibou
+
+# 测试路由表Router和处理方法的分发（405）
+
+
+def test_static_route():
+    router = hibou.Router()
+    router.add("/user/list", "list")
+    assert router.match("/user/list") == ("list", {})
+    assert router.match("/user/list/") == (None, None)
+    assert router.match("/user") == (None, None)
+
+
+def test_params():
+    router = hibou.Router()
+    router.add("/user/{id:int}", "by_id")
+    router.add("/user/{name}", "by_name")
+    router.add("/user/me", "me")
+    # 固定的段优先，整数参数优先于普通参数
+    assert router.match("/user/me") == ("me", {})
+    assert router.match("/user/12") == ("by_id", {"id": 12})
+    assert router.match("/user/bob") == ("by_name", {"name": "bob"})
+    # 空的段不匹配参数
+    assert router.match("/user/") == (None, None)
+
+
+def test_wildcard():
+    router = hibou.Router()
+    router.add("/user/{id:int}/files/{path:*}", "files")
+    assert router.match("/user/1/files/a/b.txt") == ("files", {"id": 1, "path": "a/b.txt"})
+    assert router.match("/user/1/files/") == ("files", {"id": 1, "path": ""})
+    assert router.match("/user/x/files/a") == (None, None)
+
+
+def test_invalid_routes():
+    router = hibou.Router()
+    for path in ("/a/{p:*}/b", "/a/{id:float}", "/a/x{id}"):
+        try:
+            router.add(path, "h")
+        except ValueError:
+            continue
+        raise AssertionError("route %s should be rejected" % path)
+    router.add("/a/{id:int}", "h")
+    try:
+        router.add("/a/{num:int}/b", "h")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("conflicting param names should be rejected")
+
+
+class _GetOnlyHandler(hibou.RequestHandler):
+    def get(self):
+        self.write("ok")
+
+
+class _FakeSession:
+    session_id = "test"
+
+
+def test_method_not_allowed():
+    dispatch = hibou.HandlerDispatch(_GetOnlyHandler)
+    assert set(dispatch.methods) == {"get"}
+    assert dispatch.allow == "GET"
+
+    hibou.Application.ins().add_route("/test/router/405", _GetOnlyHandler)
+    handler = hibou.SessionHandler(_FakeSession())
+    handler.request.path = "/test/router/405"
+    handler.request.method = "post"
+    try:
+        asyncio.run(handler.do_method())
+    except hibou.RequestParseException as e:
+        assert e.code == 405
+        assert e.headers == {"Allow": "GET"}
+    else:
+        raise AssertionError("POST should return 405")
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+    print("ok")
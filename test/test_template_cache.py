@@ -0,0 +1,78 @@
+# -*- coding:utf-8 -*-
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hibou
+
+# 测试模板片段缓存 {% cache key ttl %} 的参数解析和渲染
+
+
+def test_parse_cache_args():
+    def parse(suffix):
+        key, ttl = hibou._TemplateReader._parse_cache_args(suffix)
+        return key.strip(), ttl
+    # key中可以有空格
+    assert parse('"d-%s" % uid') == ('"d-%s" % uid', None)
+    assert parse('f(a, b)') == ('f(a, b)', None)
+    # 最后的数字是ttl
+    assert parse('"k" 60') == ('"k"', '60')
+    assert parse('"d-%s" % uid 60') == ('"d-%s" % uid', '60')
+    # ttl=表达式
+    assert parse('"k" ttl=60 * 5') == ('"k"', '60 * 5')
+    assert parse('"d-%s" % uid ttl=ttl_seconds') == ('"d-%s" % uid', 'ttl_seconds')
+    # 分开后key不是完整的表达式时，整个作为key
+    assert parse('f(a, ttl=3)') == ('f(a, ttl=3)', None)
+    assert parse('x - 60') == ('x - 60', None)
+    assert parse('items[ 60') == ('items[ 60', None)
+
+
+def test_render():
+    cache = hibou.FragmentCache()
+    template = hibou.Template('{% cache "d-%s" % uid %}{{ n }}{% end %}|{% cache "k" 60 %}{{ n }}{% end %}')
+    assert template.generate(uid=1, n=1, _tt_cache=cache) == "1|1"
+    assert template.generate(uid=1, n=2, _tt_cache=cache) == "1|1"
+    assert template.generate(uid=2, n=3, _tt_cache=cache) == "3|1"
+    assert cache.stats()["count"] == 3
+
+
+def test_same_line_blocks():
+    # 同一行中key相同的两个片段不会互相覆盖
+    cache = hibou.FragmentCache()
+    template = hibou.Template('{% cache "k" %}a{{ n }}{% end %}{% cache "k" %}b{{ n }}{% end %}')
+    assert template.generate(n=1, _tt_cache=cache) == "a1b1"
+    assert template.generate(n=2, _tt_cache=cache) == "a1b1"
+
+
+def test_ttl():
+    cache = hibou.FragmentCache()
+    template = hibou.Template('{% cache "k" ttl=0.05 %}{{ n }}{% end %}')
+    assert template.generate(n=1, _tt_cache=cache) == "1"
+    assert template.generate(n=2, _tt_cache=cache) == "1"
+    time.sleep(0.1)
+    assert template.generate(n=3, _tt_cache=cache) == "3"
+
+
+def test_fragment_cache_evict():
+    cache = hibou.FragmentCache(max_count=2, max_length=10)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1"
+    cache.set("c", "3")
+    # 淘汰最久没有使用的b
+    assert cache.get("b") is None
+    assert cache.get("a") == "1" and cache.get("c") == "3"
+    cache.set("d", "x" * 10)
+    assert cache.stats()["count"] == 1
+    cache.set("e", "x" * 11)
+    assert cache.get("e") is None
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+    print("ok")